@@ -16,11 +16,28 @@
         <ul style="list-style-type:square">
             <li>ON/OFF Switches - Allow control of ON/OFF state as well as reporting of current state</li>
             <li>Link LED Bulbs - Allow control of ON/OFF/DIMMER state as well as reporting of current state</li>
+            <li>Insight Switches - Same as ON/OFF Switches plus power (Watt) and energy (kWh) devices</li>
         </ul>
         <h3>Configuration</h3>
         There is no configuration required here. Devices can be renamed in Domoticz or you can rename them in the WEMO app and remove them from Domoticz so they are detected with a new name or layout.
     </description>
     <params>
+        <param field="Mode1" label="Poll Workers" width="75px" required="true" default="8"/>
+        <param field="Mode2" label="Poll Interval (s)" width="75px" required="true" default="10"/>
+        <param field="Mode3" label="Discovery Interval (s)" width="75px" required="true" default="600"/>
+        <param field="Mode4" label="Event Subscriptions" width="75px">
+            <options>
+                <option label="Disabled" value="0" default="true" />
+                <option label="Enabled" value="1"/>
+            </options>
+        </param>
+        <param field="Port" label="Event Port" width="75px" required="true" default="8900"/>
+        <param field="Mode5" label="Statistics Devices" width="75px">
+            <options>
+                <option label="Disabled" value="0" default="true" />
+                <option label="Enabled" value="1"/>
+            </options>
+        </param>
         <param field="Mode6" label="Debug" width="150px">
             <options>
                 <option label="None" value="0"  default="true" />
@@ -42,11 +59,91 @@ import socket
 import html
 import sys
 import time
-from httplib2 import Http
+import heapq
+import bisect
+import json
+import os
+import re
+import collections
+import socketserver
+import http.client
+from concurrent.futures import ThreadPoolExecutor, wait, as_completed
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit
+
+# Lock serializing access to Devices (updates come from several poll worker threads)
+devicesLock = threading.RLock()
 
 class BasePlugin:
     # WEMOs detected in network (WEMO udn to IP:PORT location)
     wemos = {}
+    # Worker pool used to poll WEMOs in parallel
+    pollPool = None
+    # Seconds between status poll cycles (a cycle waits for its workers up to 80% of it)
+    pollInterval = 10
+    # Seconds between SSDP searches (WEMOs are mostly found by listening to their announcements)
+    discoveryInterval = 600
+    # Set to stop the scheduler thread
+    stopEvent = threading.Event()
+    # Local HTTP server receiving UPnP event NOTIFY requests (None when event subscriptions are disabled)
+    eventServer = None
+    # Port the event server listens on (WEMOs are given it in the subscription callback)
+    eventPort = 8900
+    # Requested subscription duration and how long before expiry it is renewed (seconds)
+    subscriptionTimeout = 600
+    subscriptionRenew = 60
+    # udns being subscribed to (their initial event can arrive before we have the SID from the SUBSCRIBE response, so events with
+    # unknown SIDs wait for the subscription up to subscribingWait seconds)
+    subscribing = set()
+    subscribingCond = threading.Condition()
+    subscribingWait = 2
+    # Seconds between status polls of WEMOs that keep us updated through events
+    eventPollInterval = 300
+    # WEMOs with changes in the last pollActiveWindow seconds are polled every cycle, idle ones back off up to pollIdleInterval
+    pollActiveWindow = 60
+    pollIdleInterval = 60
+    # Consecutive failed polls before a WEMO is considered down, it is then only probed with backoff up to breakerMaxBackoff seconds
+    breakerThreshold = 3
+    breakerMaxBackoff = 600
+    # Seconds between scans of Link bridge devices/groups (also rescanned when bridge reboots or moves, or one of its devices is removed from Domoticz)
+    topologyInterval = 3600
+    # Maximum number of keep-alive connections to each WEMO
+    connectionsPerHost = 2
+    # Lock for adding/removing WEMOs (done by scheduler and SSDP listener threads)
+    wemosLock = threading.RLock()
+    # Ports WEMOs listen on (they often move to another one when rebooted), probed in parallel when a WEMO stops responding
+    relocatePorts = (49152, 49153, 49154, 49155)
+    relocatePool = None
+    # Minimum seconds between searches for the same WEMO
+    relocateInterval = 30
+    # Commands waiting to be sent by the command thread (by DeviceID, oldest first)
+    commands = collections.OrderedDict()
+    commandsCond = threading.Condition()
+    # Seconds to wait for more commands to the same bridge so they are sent in a single request
+    commandBatchWindow = 0.1
+    # Commands to different WEMOs are sent in parallel by commandWorkers workers, commandUDNs are the udns being sent a command
+    # (one command at a time for each WEMO)
+    commandWorkers = 4
+    commandPool = None
+    commandUDNs = set()
+    # WEMOs are saved to a snapshot file every snapshotInterval seconds (and on stop) to start quickly next time,
+    # entries not seen for snapshotMaxAge seconds are dropped
+    snapshotInterval = 300
+    snapshotMaxAge = 7*86400
+    lastSnapshot = 0
+    # Seconds between statistics reports (debug log summary and statistics devices)
+    statsInterval = 300
+    statsEnabled = False
+    # Statistics devices: DeviceID, name, Type, Subtype, Options
+    statsDevices = (
+        ('stats-cycle', 'WEMO Poll Cycle', 243, 31, { 'Custom' : '1;ms' }),
+        ('stats-latency', 'WEMO Request Latency', 243, 31, { 'Custom' : '1;ms' }),
+        ('stats-failures', 'WEMO Request Failures', 243, 31, { 'Custom' : '1;requests' }),
+        ('stats-summary', 'WEMO Statistics', 243, 19, {}),
+    )
+    # udns currently being polled by a worker (so a slow WEMO is not queued twice)
+    polling = set()
+    pollingLock = threading.Lock()
 
     def __init__(self):
         return
@@ -56,17 +153,86 @@ class BasePlugin:
         if Parameters["Mode6"] != "0":
             Domoticz.Debugging(int(Parameters["Mode6"]))
             DumpConfigToLog()
-        # Mark all existing devices as off/timed out initially (until they are discovered)
+        # Index existing devices and their state
+        registry.rebuild()
+        shadow.rebuild()
+        # Load WEMOs known from last run
+        self.loadSnapshot()
+        # Mark all other existing devices as off/timed out initially (until they are discovered)
+        statsIDs = [d[0] for d in self.statsDevices]
         for u in Devices:
-            UpdateDevice(u, 0, 'Off', True)
-        # Create/Start update thread
+            if registry.owner(Devices[u].DeviceID) not in self.wemos and Devices[u].DeviceID not in statsIDs:
+                UpdateDevice(u, 0, 'Off', True)
+        # Create statistics devices
+        self.statsEnabled = Parameters["Mode5"] == "1"
+        if self.statsEnabled:
+            self.createStatsDevices()
+        # Create poll worker pool
+        workers = int(Parameters["Mode1"]) if Parameters["Mode1"].isdigit() and int(Parameters["Mode1"]) > 0 else 8
+        self.pollPool = ThreadPoolExecutor(max_workers=workers)
+        self.relocatePool = ThreadPoolExecutor(max_workers=len(self.relocatePorts)*2)
+        self.commandPool = ThreadPoolExecutor(max_workers=self.commandWorkers)
+        # Sends dropped by the last stop never finished
+        self.commandUDNs.clear()
+        # Confirm WEMOs from last run are still where they were
+        for udn in list(self.wemos):
+            self.pollPool.submit(self.confirmWEMO, udn)
+        connections.maxPerHost = self.connectionsPerHost
+        connections.open()
+        # Scheduler intervals
+        if Parameters["Mode2"].isdigit() and int(Parameters["Mode2"]) > 0:
+            self.pollInterval = int(Parameters["Mode2"])
+        if Parameters["Mode3"].isdigit() and int(Parameters["Mode3"]) > 0:
+            self.discoveryInterval = int(Parameters["Mode3"])
+        # Create/Start event server (WEMOs will send their state changes to it)
+        if Parameters["Mode4"] == "1":
+            if Parameters["Port"].isdigit() and int(Parameters["Port"]) > 0:
+                self.eventPort = int(Parameters["Port"])
+            try:
+                self.eventServer = EventServer(('', self.eventPort), EventHandler)
+                self.eventThread = threading.Thread(name="WEMOEventThread", target=self.eventServer.serve_forever, kwargs={ 'poll_interval' : 0.25 })
+                self.eventThread.start()
+                Domoticz.Log("Listening for WEMO events on port "+str(self.eventPort))
+            except Exception as err:
+                self.eventServer = None
+                Domoticz.Error("Unable to listen for WEMO events on port "+str(self.eventPort)+" (WEMOs will only be polled): "+str(err))
+        # Create/Start SSDP listener thread
+        self.stopEvent.clear()
+        self.discoveryThread = threading.Thread(name="WEMODiscoveryThread", target=BasePlugin.listenSSDP, args=(self,))
+        self.discoveryThread.start()
+        # Create/Start command thread
+        self.commandThread = threading.Thread(name="WEMOCommandThread", target=BasePlugin.handleCommands, args=(self,))
+        self.commandThread.start()
+        # Create/Start scheduler thread
         self.updateThread = threading.Thread(name="WEMOUpdateThread", target=BasePlugin.handleThread, args=(self,))
         self.updateThread.start()
 
     def onStop(self):
         Domoticz.Debug("onStop called")
-        while (threading.active_count() > 1):
-            time.sleep(1.0)
+        # Ask threads to stop (they check for this before each request) and interrupt requests in progress
+        self.stopEvent.set()
+        with self.commandsCond:
+            self.commandsCond.notify_all()
+        # Cancel event subscriptions while connections are still allowed
+        if self.eventServer is not None:
+            self.unsubscribeWEMOs(0.5)
+        connections.closeAll()
+        if self.eventServer is not None:
+            self.eventServer.shutdown()
+            self.eventServer.server_close()
+            self.eventServer = None
+        # Give threads up to a second (in total) to finish
+        deadline = time.monotonic()+1
+        for thread in (self.updateThread, self.discoveryThread, self.commandThread):
+            thread.join(max(0, deadline-time.monotonic()))
+        # Wait for poll workers (they may still be waiting for relocation probes) dropping work not started yet,
+        # no thread may use the Domoticz API once we return
+        stopPool(self.pollPool)
+        stopPool(self.relocatePool)
+        stopPool(self.commandPool)
+        # Write device updates still waiting for the end of a poll cycle
+        shadow.flush()
+        self.saveSnapshot()
 
     def onConnect(self, Connection, Status, Description):
         Domoticz.Debug("onConnect called")
@@ -78,51 +244,164 @@ class BasePlugin:
         Domoticz.Debug("onCommand called for Unit " + str(Unit) + ": Parameter '" + str(Command) + "', Level: " + str(Level))
 
         # Find the udn for the Domoticz unit number provided
-        udn = ''
-        # For each WEMO udn
-        for wemoudn in self.wemos:
-            # If no devices set for this udn, skip it
-            if 'devices' not in self.wemos[wemoudn]:
-                continue
-            # If the device we want is in this WEMO, set udn for it
-            if Devices[Unit].DeviceID in self.wemos[wemoudn]['devices']:
-                udn = wemoudn
+        devid = Devices[Unit].DeviceID
+        udn = registry.owner(devid)
+        if udn not in self.wemos:
+            udn = ''
 
         # If we didn't find it, leave (probably disconnected at this time)
         if udn == '':
-            Domoticz.Error('Command for DeviceID='+Devices[Unit].DeviceID+' udn='+udn+" but device is not available.")
+            Domoticz.Error('Command for DeviceID='+devid+' udn='+udn+" but device is not available.")
             return
 
-        Domoticz.Log('Sending command for DeviceID='+Devices[Unit].DeviceID+' udn='+udn)
-
-        # If it's a Bridge (otherwise we assume it's an on/off device)
+        # Update Domoticz right away (confirmed or rolled back once the command is sent)
+        previous = shadow.get(Unit)
         if udn.startswith('uuid:Bridge-'):
-            # Send command to Group/Device
-            headers={ 'Content-type' : 'text/xml; charset="utf-8"', 'SOAPACTION' : '"urn:Belkin:service:bridge:1#SetDeviceStatus"' }
-            data='<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:SetDeviceStatus xmlns:u="urn:Belkin:service:bridge:1"><DeviceStatusList>&lt;?xml version=&quot;1.0&quot; encoding=&quot;UTF-8&quot;?&gt;&lt;DeviceStatus&gt;&lt;DeviceID&gt;'+Devices[Unit].DeviceID+'&lt;/DeviceID&gt;&lt;CapabilityID&gt;10008&lt;/CapabilityID&gt;&lt;CapabilityValue&gt;'+('0' if Command == 'Off' else str(round(Level*2.55)) )+':0&lt;/CapabilityValue&gt;&lt;IsGroupAction&gt;'+('YES' if Devices[Unit].DeviceID in self.wemos[udn]['groupids'] else 'NO')+'&lt;/IsGroupAction&gt;&lt;/DeviceStatus&gt;</DeviceStatusList></u:SetDeviceStatus></s:Body></s:Envelope>'
-            cmd = doPOST(self.wemos[udn]['location']+'/upnp/control/bridge1', data, headers)
-            Domoticz.Debug("cmdresp="+cmd)
-            # Now we have to poll the status to make sure the next poll has the updated information on it (WEMO glitch?)
-            ids = str(self.wemos[udn]['devices']).replace('[', '').replace(']', '').replace('\'', '').replace(' ', '')
-            headers={ 'Content-type' : 'text/xml; charset="utf-8"', 'SOAPACTION' : '"urn:Belkin:service:bridge:1#GetDeviceStatus"' }
-            data='<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:GetDeviceStatus xmlns:u="urn:Belkin:service:bridge:1"><DeviceIDs>'+ids+'</DeviceIDs></u:GetDeviceStatus></s:Body></s:Envelope>'
-            state = doPOST(self.wemos[udn]['location']+'/upnp/control/bridge1', data, headers)
-            # If we got a response and no error IDs, update the device for quicker update
-            if cmd != '' and getElements(cmd, 'ErrorDeviceIDs')[0] == '':
-                UpdateDevice(Unit, 0 if Command == 'Off' else 2, str(Level), Devices[Unit].TimedOut)
+            UpdateDevice(Unit, 0 if Command == 'Off' else 2, str(Level), previous[2])
         else:
-            # Send command to request change in state and read/parse status response
-            headers={ 'Content-type' : 'text/xml; charset="utf-8"', 'SOAPACTION' : '"urn:Belkin:service:basicevent:1#SetBinaryState"' }
-            data='<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:SetBinaryState xmlns:u="urn:Belkin:service:basicevent:1"><BinaryState>'+('1' if Command == 'On' else '0')+'</BinaryState></u:SetBinaryState></s:Body></s:Envelope>'
-            state = doPOST(self.wemos[udn]['location']+'/upnp/control/basicevent1', data, headers)
-            if state != '':
-                state = html.unescape(state)
-                state = getElements(state, 'BinaryState')[0]
-            # Update domoticz status (On/Off and Timed out or not)
-            if state == '' or state == '0':
-                UpdateDevice(Unit, 0, 'Off', state == '')
-            if state == '1':
-                UpdateDevice(Unit, 1, 'On', False)
+            UpdateDevice(Unit, 1 if Command == 'On' else 0, 'On' if Command == 'On' else 'Off', previous[2])
+
+        self.markActive(udn)
+
+        # Queue command for command thread (replacing any command for the same device not sent yet)
+        with self.commandsCond:
+            queued = time.monotonic()
+            if devid in self.commands:
+                Domoticz.Debug('Replacing pending command for DeviceID='+devid)
+                # Rollback should go to the state before the replaced command
+                previous = self.commands[devid]['previous']
+                queued = self.commands[devid]['time']
+            self.commands[devid] = { 'unit' : Unit, 'udn' : udn, 'command' : Command, 'level' : Level, 'previous' : previous, 'time' : queued }
+            self.commandsCond.notify()
+
+    # Command thread: hands queued commands to command workers until stopped (oldest first, commands for the same bridge go together
+    # and a WEMO is only sent its next command once the previous one is done)
+    def handleCommands(self):
+        while True:
+            with self.commandsCond:
+                while True:
+                    if self.stopEvent.is_set():
+                        return
+                    dispatch = []
+                    delay = None
+                    seen = set()
+                    for devid in list(self.commands):
+                        # Already taken with the batch of its bridge
+                        if devid not in self.commands:
+                            continue
+                        udn = self.commands[devid]['udn']
+                        if udn in seen or udn in self.commandUDNs:
+                            continue
+                        seen.add(udn)
+                        if udn.startswith('uuid:Bridge-'):
+                            # Give other commands for this bridge (i.e. from a scene) a moment to arrive so they are sent together
+                            remaining = self.commands[devid]['time']+self.commandBatchWindow-time.monotonic()
+                            if remaining > 0:
+                                delay = remaining if delay is None else min(delay, remaining)
+                                continue
+                            batch = [ (d, self.commands.pop(d)) for d in list(self.commands) if self.commands[d]['udn'] == udn ]
+                        else:
+                            batch = [ (devid, self.commands.pop(devid)) ]
+                        self.commandUDNs.add(udn)
+                        dispatch.append((udn, batch))
+                    if len(dispatch) > 0:
+                        break
+                    self.commandsCond.wait(delay)
+            for udn, batch in dispatch:
+                try:
+                    self.commandPool.submit(self.sendQueued, udn, batch)
+                except RuntimeError:
+                    # Command workers shut down (plugin stopping)
+                    return
+
+    # Command worker: send batch to udn and let the command thread know udn can take its next command
+    def sendQueued(self, udn, batch):
+        try:
+            self.sendCommands(udn, batch)
+        finally:
+            with self.commandsCond:
+                self.commandUDNs.discard(udn)
+                self.commandsCond.notify_all()
+
+    # Check if there are commands being sent or waiting to be sent to udn
+    def commandsPending(self, udn):
+        with self.commandsCond:
+            if udn in self.commandUDNs:
+                return True
+            for devid in self.commands:
+                if self.commands[devid]['udn'] == udn:
+                    return True
+        return False
+
+    # Send list of (DeviceID, command) to WEMO, confirming the device states (or rolling them back if they failed)
+    def sendCommands(self, udn, batch):
+        try:
+            # Plugin stopping (devices are polled again on start)
+            if self.stopEvent.is_set():
+                return
+            Domoticz.Log('Sending command for DeviceID='+','.join([devid for devid, cmd in batch])+' udn='+udn)
+
+            # If it's a Bridge (otherwise we assume it's an on/off device)
+            if udn.startswith('uuid:Bridge-'):
+                # Send command to all Groups/Devices at once
+                status = ''
+                for devid, cmd in batch:
+                    status += '&lt;DeviceStatus&gt;&lt;DeviceID&gt;'+devid+'&lt;/DeviceID&gt;&lt;CapabilityID&gt;10008&lt;/CapabilityID&gt;&lt;CapabilityValue&gt;'+('0' if cmd['command'] == 'Off' else str(round(cmd['level']*2.55)) )+':0&lt;/CapabilityValue&gt;&lt;IsGroupAction&gt;'+('YES' if registry.isGroup(devid) else 'NO')+'&lt;/IsGroupAction&gt;&lt;/DeviceStatus&gt;'
+                if len(batch) > 1:
+                    status = '&lt;DeviceStatusList&gt;'+status+'&lt;/DeviceStatusList&gt;'
+                cmdresp = doSOAP(self.wemos[udn]['location'], 'bridge', 'SetDeviceStatus', '<DeviceStatusList>&lt;?xml version=&quot;1.0&quot; encoding=&quot;UTF-8&quot;?&gt;'+status+'</DeviceStatusList>')
+                Domoticz.Debug("cmdresp="+cmdresp)
+                if self.stopEvent.is_set():
+                    return
+                # Now we have to poll the status to make sure the next poll has the updated information on it (WEMO glitch?)
+                doSOAP(self.wemos[udn]['location'], 'bridge', 'GetDeviceStatus', '<DeviceIDs>'+','.join(self.wemos[udn]['devices'])+'</DeviceIDs>')
+                # If we got a response the optimistic update stands for devices without errors, others are rolled back
+                errors = getElements(cmdresp, 'ErrorDeviceIDs')
+                errors = set(errors[0].split(',')) if len(errors) > 0 else set()
+                for devid, cmd in batch:
+                    if cmdresp != '' and devid not in errors:
+                        UpdateDevice(cmd['unit'], 0 if cmd['command'] == 'Off' else 2, str(cmd['level']), cmd['previous'][2])
+                    else:
+                        self.rollbackCommand(devid, cmd)
+            else:
+                devid, cmd = batch[0]
+                # Send command to request change in state and read/parse status response
+                state = doSOAP(self.wemos[udn]['location'], 'basicevent', 'SetBinaryState', '<BinaryState>'+('1' if cmd['command'] == 'On' else '0')+'</BinaryState>')
+                if state != '':
+                    state = getElements(state, 'BinaryState')[0].split('|')[0]
+                # Insight on standby (switched on without load)
+                if state == '8':
+                    state = '1'
+                # Update domoticz status (On/Off or roll back if it didn't answer)
+                if state == '':
+                    self.rollbackCommand(devid, cmd)
+                if state == '0':
+                    UpdateDevice(cmd['unit'], 0, 'Off', False)
+                if state == '1':
+                    UpdateDevice(cmd['unit'], 1, 'On', False)
+
+        except Exception as err:
+            Domoticz.Error("sendCommands: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+            for devid, cmd in batch:
+                self.rollbackCommand(devid, cmd)
+
+    # Restore device state from before a failed command (unless a newer command for it is already queued)
+    def rollbackCommand(self, devid, cmd):
+        with self.commandsCond:
+            if devid in self.commands:
+                return
+        Domoticz.Error('Command for DeviceID='+devid+' udn='+cmd['udn']+' failed')
+        UpdateDevice(cmd['unit'], cmd['previous'][0], cmd['previous'][1], True)
+
+    def onDeviceRemoved(self, Unit):
+        Domoticz.Debug("onDeviceRemoved called for Unit " + str(Unit))
+        # Link devices are only created by bridge scans, rescan the bridge on its next poll (polled soon) so it is added again
+        owner = registry.owner(Devices[Unit].DeviceID) if Unit in Devices else ''
+        if owner.startswith('uuid:Bridge-') and owner in self.wemos:
+            self.wemos[owner]['rescan'] = True
+            self.markActive(owner)
+        registry.remove(Unit)
+        shadow.remove(Unit)
 
     def onNotification(self, Name, Subject, Text, Status, Priority, Sound, ImageFile):
         Domoticz.Debug("Notification: " + Name + "," + Subject + "," + Text + "," + Status + "," + str(Priority) + "," + Sound + "," + ImageFile)
@@ -132,12 +411,44 @@ class BasePlugin:
 
     def onHeartbeat(self):
         Domoticz.Debug("onHeartbeat called")
-        # Create/Start update thread
-        self.updateThread = threading.Thread(name="WEMOUpdateThread", target=BasePlugin.handleThread, args=(self,))
-        self.updateThread.start()
+        # Restart scheduler thread if it died for some reason (it runs its own discovery/poll intervals)
+        if not self.stopEvent.is_set() and not self.updateThread.is_alive():
+            Domoticz.Error("Scheduler thread not running, restarting it")
+            self.updateThread = threading.Thread(name="WEMOUpdateThread", target=BasePlugin.handleThread, args=(self,))
+            self.updateThread.start()
 
-    # Separate thread looping ever 10 seconds searching for new WEMOs on network and updating their status
+    # Scheduler thread: runs discovery and poll cycles (never overlapping) on their own intervals until stopped
     def handleThread(self):
+        nextDiscovery = nextPoll = time.monotonic()
+        nextStats = nextPoll + self.statsInterval
+        # WEMOs from last run can be polled right away (those we don't know will be found as they announce themselves)
+        if len(self.wemos) > 0:
+            nextDiscovery = nextDiscovery + self.pollInterval
+        while not self.stopEvent.is_set():
+            if time.monotonic() >= nextDiscovery:
+                self.discoverWEMOs()
+                nextDiscovery = self.nextTick('Discovery', nextDiscovery, self.discoveryInterval)
+            if time.monotonic() >= nextPoll and not self.stopEvent.is_set():
+                self.pollWEMOs()
+                nextPoll = self.nextTick('Poll', nextPoll, self.pollInterval)
+            if time.monotonic() >= nextStats and not self.stopEvent.is_set():
+                self.reportStats()
+                nextStats = self.nextTick('Statistics', nextStats, self.statsInterval)
+            # Sleep until next cycle is due (or we're asked to stop)
+            self.stopEvent.wait(max(0, min(nextDiscovery, nextPoll)-time.monotonic()))
+
+    # Calculate when a cycle is due next, merging any ticks we missed by falling behind
+    def nextTick(self, name, due, interval):
+        due = due + interval
+        now = time.monotonic()
+        if due <= now:
+            missed = int((now-due)//interval)+1
+            Domoticz.Debug(name+' cycle fell behind, merging '+str(missed)+' tick(s)')
+            due = due + missed*interval
+        return due
+
+    # Search for new WEMOs on network
+    def discoverWEMOs(self):
         try:
             Domoticz.Debug("Searching for WEMOs ...")
 
@@ -150,124 +461,628 @@ class BasePlugin:
                 'MAN:"ssdp:discover"\r\n' \
                 '\r\n'
 
-            # Set up discovery UDP socket
+            # Set up discovery UDP socket (short timeout so we can check for stop requests)
             s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-            s.settimeout(2)
+            s.settimeout(0.25)
 
             # Send discovery message
             s.sendto(discmsg.encode() , ('239.255.255.250', 1900) )
 
-            # Read discovery responses
-            try:
-                while True:
+            # Read discovery responses for 2 seconds
+            start = last = time.monotonic()
+            end = start + 2
+            while time.monotonic() < end and not self.stopEvent.is_set():
+                try:
                     # Receive and decode bytes to string
                     data, addr = s.recvfrom(65507)
-                    data = data.decode()
-                    # Clean up loc an udn
-                    loc = ''
-                    udn = ''
-                    for line in data.splitlines():
-                        if line.startswith('LOCATION:') and line.endswith('/setup.xml'):
-                            loc = line[9:len(line)-10].strip()
-                            Domoticz.Debug('WEMO detected: '+loc)
-                        if line.startswith('USN:') and line.endswith('::upnp:rootdevice'):
-                            udn = line[4:len(line)-17].strip()
-                        if loc != '' and udn != '':
-                            if udn not in self.wemos:
-                                self.wemos[udn] = { "location" : loc }
-                            else:
-                                self.wemos[udn]['location'] = loc
-                            loc = ''
-                            udn = ''
-            except socket.timeout:
-                pass
-
-            # Update device statuses
-            for udn in self.wemos:
-                self.updateWEMO( udn )
+                except socket.timeout:
+                    continue
+                self.foundWEMO(parseSSDP(data.decode()))
+                last = time.monotonic()
+            s.close()
+            # Time until the last WEMO answered
+            if last > start:
+                stats.timing('discovery', last-start)
 
         except Exception as err:
-            Domoticz.Error("handleThread: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+            Domoticz.Error("discoverWEMOs: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+            stats.count('exceptions')
 
-    # Update WEMO information for provided udn
+    # Listen for SSDP NOTIFY (alive/byebye) messages so WEMOs are found as they announce themselves
+    def listenSSDP(self):
+        try:
+            # Join SSDP multicast group (short timeout so we can check for stop requests)
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, 'SO_REUSEPORT'):
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            s.bind(('', 1900))
+            s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton('239.255.255.250')+socket.inet_aton('0.0.0.0'))
+            s.settimeout(0.25)
+        except Exception as err:
+            Domoticz.Error("listenSSDP: unable to listen for SSDP announcements ("+str(err)+"), relying on periodic searches")
+            return
+
+        while not self.stopEvent.is_set():
+            try:
+                try:
+                    data, addr = s.recvfrom(65507)
+                except socket.timeout:
+                    continue
+                data = data.decode('utf-8', 'replace')
+                if not data.startswith('NOTIFY'):
+                    continue
+                headers = parseSSDP(data)
+                if headers.get('NTS', '') == 'ssdp:byebye':
+                    usn = headers.get('USN', '')
+                    if usn.endswith('::upnp:rootdevice'):
+                        self.forgetWEMO(usn[:-17], 'said goodbye')
+                else:
+                    self.foundWEMO(headers)
+
+            except Exception as err:
+                Domoticz.Error("listenSSDP: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+        s.close()
+
+    # Add/refresh WEMO from SSDP headers (M-SEARCH response or alive NOTIFY)
+    def foundWEMO(self, headers):
+        loc = headers.get('LOCATION', '')
+        usn = headers.get('USN', '')
+        if not loc.endswith('/setup.xml') or not usn.endswith('::upnp:rootdevice'):
+            return
+        loc = loc[:-10]
+        udn = usn[:-17]
+        # Announcement is valid for max-age seconds
+        maxage = 1800
+        for directive in headers.get('CACHE-CONTROL', '').split(','):
+            directive = directive.strip()
+            if directive.startswith('max-age=') and directive[8:].isdigit():
+                maxage = int(directive[8:])
+        with self.wemosLock:
+            if udn not in self.wemos:
+                Domoticz.Debug('WEMO detected: '+loc)
+                self.wemos[udn] = { "location" : loc }
+            elif self.wemos[udn]['location'] != loc:
+                self.moveWEMO(udn, loc)
+            # WEMO rebooted (devices/groups may have changed and it forgot our subscriptions, they're made again next cycle)
+            bootid = headers.get('BOOTID.UPNP.ORG', '')
+            if self.wemos[udn].get('bootid', bootid) != bootid:
+                self.wemos[udn]['rescan'] = True
+                self.wemos[udn].pop('subs', None)
+            self.wemos[udn]['bootid'] = bootid
+            self.wemos[udn]['maxage'] = maxage
+            self.wemos[udn]['expires'] = time.monotonic()+maxage
+            self.wemos[udn]['seen'] = time.time()
+
+    # WEMO is now at a different location (it was rebooted, so devices/groups may have changed too)
+    def moveWEMO(self, udn, loc):
+        with self.wemosLock:
+            Domoticz.Debug('WEMO moved: '+loc)
+            # Connections and subscriptions were made to the old location
+            connections.drop(self.wemos[udn]['location'])
+            self.wemos[udn]['location'] = loc
+            self.wemos[udn].pop('subs', None)
+            self.wemos[udn]['rescan'] = True
+
+    # Look for WEMO that stopped responding on the other ports of its IP, returns True if it was found (and moved)
+    def relocateWEMO(self, udn):
+        wemo = self.wemos.get(udn)
+        if self.stopEvent.is_set() or wemo is None or time.monotonic()-wemo.get('relocated', 0) < self.relocateInterval:
+            return False
+        wemo['relocated'] = time.monotonic()
+        u = urlsplit(wemo['location'])
+        futures = {}
+        for port in self.relocatePorts:
+            if port != u.port:
+                loc = u.scheme+'://'+u.hostname+':'+str(port)
+                futures[self.relocatePool.submit(probeSetup, loc, udn)] = loc
+        for future in as_completed(futures):
+            if future.result():
+                Domoticz.Log('WEMO udn='+udn+' moved to '+futures[future])
+                self.moveWEMO(udn, futures[future])
+                return True
+        Domoticz.Debug('WEMO udn='+udn+' not found on other ports')
+        return False
+
+    # Remove WEMO (it left or its announcement expired) and flag its devices as timed out
+    def forgetWEMO(self, udn, reason):
+        with self.wemosLock:
+            wemo = self.wemos.pop(udn, None)
+        if wemo is None:
+            return
+        Domoticz.Log('WEMO udn='+udn+' '+reason)
+        connections.drop(wemo['location'])
+        self.timeoutDevices(udn, wemo)
+
+    # Flag devices of udn as timed out (keeping their last known state)
+    def timeoutDevices(self, udn, wemo=None):
+        if wemo is None:
+            wemo = self.wemos.get(udn, {})
+        for devid in wemo.get('devices', []):
+            unit = getUnit(devid)
+            with devicesLock:
+                state = shadow.get(unit)
+                if state is not None:
+                    UpdateDevice(unit, state[0], state[1], True)
+
+    # WEMO answered us (poll or event), keep it for another announcement max-age even if its announcements are lost (multicast over Wi-Fi)
+    def extendWEMO(self, udn):
+        wemo = self.wemos.get(udn, {})
+        if 'expires' in wemo:
+            wemo['expires'] = time.monotonic()+wemo.get('maxage', 1800)
+
+    # Forget WEMOs whose SSDP announcement expired without them answering a poll or sending an event since (no I/O)
+    def expireWEMOs(self):
+        now = time.monotonic()
+        for udn in [u for u in list(self.wemos) if self.wemos.get(u, {}).get('expires', now) < now]:
+            self.forgetWEMO(udn, 'announcement expired')
+        # WEMOs from last run that were never announced (or answered) again
+        for udn in [u for u in list(self.wemos) if time.time()-self.wemos.get(u, {}).get('seen', time.time()) > self.snapshotMaxAge]:
+            self.forgetWEMO(udn, 'not seen for too long')
+
+    # Check WEMO from last run is still at its location (by its setup.xml), flagging its devices as timed out if not
+    def confirmWEMO(self, udn):
+        try:
+            if self.stopEvent.is_set():
+                return
+            if probeSetup(self.wemos[udn]['location'], udn):
+                Domoticz.Debug('Confirmed udn='+udn+' at '+self.wemos[udn]['location'])
+                self.wemos[udn]['seen'] = time.time()
+            elif self.relocateWEMO(udn):
+                self.wemos[udn]['seen'] = time.time()
+            elif not self.stopEvent.is_set():
+                Domoticz.Debug('Unable to confirm udn='+udn+' at '+self.wemos[udn]['location'])
+                self.timeoutDevices(udn)
+
+        except Exception as err:
+            Domoticz.Error("confirmWEMO: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+
+    # Load WEMOs (location, devices and bridge topology) saved on last run
+    def loadSnapshot(self):
+        try:
+            with open(Parameters["HomeFolder"]+'wemos.json') as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return
+        try:
+            for udn in snapshot:
+                wemo = snapshot[udn]
+                age = time.time()-wemo.get('seen', 0)
+                if age > self.snapshotMaxAge or 'location' not in wemo:
+                    continue
+                self.wemos[udn] = { 'location' : wemo['location'], 'devices' : wemo.get('devices', []), 'bootid' : wemo.get('bootid', ''), 'seen' : wemo['seen'] }
+                registry.setOwner(udn, self.wemos[udn]['devices'])
+                if 'topology' in wemo:
+                    groups = wemo['topology']['groups']
+                    groupIDs = list(groups)
+                    registry.setGroups(udn, groupIDs, [groups[g] for g in groupIDs])
+                    # Keep topology age so it is refreshed on schedule
+                    scanned = time.monotonic()-(time.time()-wemo['topology']['scanned'])
+                    self.wemos[udn]['topology'] = { 'time' : scanned, 'groups' : dict([(g, set(groups[g])) for g in groupIDs]), 'ids' : set(wemo['topology']['ids']) }
+            Domoticz.Log('Loaded '+str(len(self.wemos))+' WEMOs from last run')
+
+        except Exception as err:
+            Domoticz.Error("loadSnapshot: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+
+    # Save WEMOs (location, devices and bridge topology) for next run
+    def saveSnapshot(self):
+        try:
+            self.lastSnapshot = time.monotonic()
+            snapshot = {}
+            for udn in list(self.wemos):
+                wemo = self.wemos.get(udn)
+                if wemo is None:
+                    continue
+                snapshot[udn] = { 'location' : wemo['location'], 'devices' : list(wemo.get('devices', [])), 'bootid' : wemo.get('bootid', ''), 'seen' : wemo.get('seen', time.time()) }
+                if 'topology' in wemo:
+                    topology = wemo['topology']
+                    snapshot[udn]['topology'] = { 'scanned' : time.time()-(time.monotonic()-topology['time']), 'groups' : dict([(g, sorted(topology['groups'][g])) for g in topology['groups']]), 'ids' : sorted(topology['ids']) }
+            filename = Parameters["HomeFolder"]+'wemos.json'
+            with open(filename+'.tmp', 'w') as f:
+                json.dump(snapshot, f)
+            os.replace(filename+'.tmp', filename)
+
+        except Exception as err:
+            Domoticz.Error("saveSnapshot: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+
+    # Update device statuses in parallel (cycle time is set by the slowest WEMO, not the sum of all)
+    def pollWEMOs(self):
+        try:
+            start = time.monotonic()
+            self.expireWEMOs()
+            futures = {}
+            for udn in list(self.wemos):
+                if self.stopEvent.is_set():
+                    break
+                if not self.pollDue(udn, start):
+                    continue
+                with self.pollingLock:
+                    if udn in self.polling:
+                        Domoticz.Debug('Still polling udn='+udn+' from a previous cycle, skipping it')
+                        continue
+                    self.polling.add(udn)
+                futures[self.pollPool.submit(self.pollWEMO, udn)] = udn
+            # Wait for workers until deadline (in small steps so we can check for stop requests)
+            notdone = set(futures)
+            deadline = start + self.pollInterval*0.8
+            while len(notdone) > 0 and time.monotonic() < deadline and not self.stopEvent.is_set():
+                done, notdone = wait(notdone, timeout=min(0.1, max(0, deadline-time.monotonic())))
+            if self.stopEvent.is_set():
+                for f in notdone:
+                    f.cancel()
+                return
+            # Write device updates of WEMOs done polling (those still being polled go with the cycle after they finish)
+            with self.pollingLock:
+                busy = set(self.polling)
+            shadow.flush(busy)
+            if len(notdone) > 0:
+                Domoticz.Error('Poll deadline missed by udn='+', '.join(sorted([futures[f] for f in notdone])))
+                stats.count('overruns')
+            stats.timing('cycle', time.monotonic()-start)
+            Domoticz.Debug('Poll cycle took '+str(round(time.monotonic()-start, 2))+'s for '+str(len(futures))+' WEMOs')
+            if time.monotonic()-self.lastSnapshot >= self.snapshotInterval:
+                self.saveSnapshot()
+
+        except Exception as err:
+            Domoticz.Error("pollWEMOs: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+            stats.count('exceptions')
+
+    # Create statistics devices that don't exist yet
+    def createStatsDevices(self):
+        with devicesLock:
+            for devid, name, devtype, subtype, options in self.statsDevices:
+                if getUnit(devid) == 0:
+                    unit = nextUnit()
+                    Domoticz.Device(Name=name, Unit=unit, Type=devtype, Subtype=subtype, Options=options, DeviceID=devid).Create()
+                    registry.add(unit, devid)
+
+    # Log statistics of last interval (if debugging) and show them in the statistics devices (if enabled)
+    def reportStats(self):
+        try:
+            counters, timings = stats.take()
+            cycle = timings.get('cycle', Histogram())
+            requests = Histogram()
+            for key in timings:
+                if isinstance(key, tuple):
+                    requests.merge(timings[key])
+            failures = counters['timeouts']+counters['errors']
+            summary = 'Cycles: '+cycle.describe()+', '+str(counters['overruns'])+' overruns'
+            summary += '; Requests: '+requests.describe()+', '+str(counters['timeouts'])+' timeouts, '+str(counters['errors'])+' errors'
+            summary += '; Discovery: '+timings.get('discovery', Histogram()).describe()
+            summary += '; Updates: '+str(counters['writes'])+' of '+str(counters['updates'])+'; Exceptions: '+str(counters['exceptions'])
+            if Parameters["Mode6"] != "0":
+                Domoticz.Debug('Statistics: '+summary)
+                # Latency of each WEMO by action
+                names = dict([(wemo['location'], udn) for udn, wemo in list(self.wemos.items())])
+                for key in sorted([k for k in timings if isinstance(k, tuple)]):
+                    Domoticz.Debug('Statistics: '+names.get(key[0], key[0])+' '+key[1]+': '+timings[key].describe())
+                Domoticz.Debug('Connections: '+str(connections.stats()))
+            if self.statsEnabled:
+                UpdateDevice(getUnit('stats-cycle'), 0, str(round(cycle.average()*1000)), False)
+                UpdateDevice(getUnit('stats-latency'), 0, str(round(requests.average()*1000)), False)
+                UpdateDevice(getUnit('stats-failures'), 0, str(failures), False)
+                UpdateDevice(getUnit('stats-summary'), 0, summary, False)
+
+        except Exception as err:
+            Domoticz.Error("reportStats: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+
+    # Poll worker entry point: update WEMO and release it for the next cycle
+    def pollWEMO(self, udn):
+        try:
+            shadow.defer(udn)
+            # Plugin stopping (checked before each request, failures are not counted then)
+            if self.stopEvent.is_set():
+                return
+            poll = self.wemos[udn].setdefault('poll', { 'interval' : self.pollInterval, 'next' : 0, 'failures' : 0 })
+            if self.eventServer is not None and poll['failures'] < self.breakerThreshold:
+                self.subscribeWEMO(udn)
+            # Not due yet (we were only called to renew subscriptions)
+            if time.monotonic() < poll['next'] or self.stopEvent.is_set():
+                return
+            # Status would be stale while commands are on their way (they update the devices themselves)
+            if self.commandsPending(udn):
+                return
+            # If WEMO is down only try a full update once it accepts connections again (or is found on another port)
+            if poll['failures'] >= self.breakerThreshold and not probeWEMO(self.wemos[udn]['location']) and not self.relocateWEMO(udn):
+                if not self.stopEvent.is_set():
+                    self.pollFailed(udn, poll)
+                return
+            self.wemos[udn]['lastpoll'] = time.monotonic()
+            if self.updateWEMO(udn):
+                self.pollSucceeded(udn, poll)
+            # WEMO may have moved to another port after a reboot, update it right away if found there
+            elif self.relocateWEMO(udn) and self.updateWEMO(udn):
+                self.pollSucceeded(udn, poll)
+            elif not self.stopEvent.is_set():
+                self.pollFailed(udn, poll)
+
+        except Exception as err:
+            Domoticz.Error("pollWEMO: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+        finally:
+            shadow.defer('')
+            with self.pollingLock:
+                self.polling.discard(udn)
+
+    # Check if udn needs polling (status is due or its event subscription needs renewing)
+    def pollDue(self, udn, now):
+        wemo = self.wemos.get(udn, {})
+        if 'poll' not in wemo or now >= wemo['poll']['next']:
+            return True
+        return self.eventServer is not None and wemo['poll']['failures'] < self.breakerThreshold and self.subscriptionExpiring(udn)
+
+    # Schedule next poll: often if WEMO changed recently, less and less often while it stays idle
+    def pollSucceeded(self, udn, poll):
+        if poll['failures'] >= self.breakerThreshold:
+            Domoticz.Log('WEMO udn='+udn+' is responding again')
+        poll['failures'] = 0
+        self.wemos[udn]['seen'] = time.time()
+        self.extendWEMO(udn)
+        now = time.monotonic()
+        if self.eventsFlowing(udn):
+            poll['interval'] = self.eventPollInterval
+        elif now-self.wemos[udn].get('lastchange', 0) < self.pollActiveWindow:
+            poll['interval'] = self.pollInterval
+        else:
+            poll['interval'] = min(poll['interval']*2, max(self.pollInterval, self.pollIdleInterval))
+        poll['next'] = now+poll['interval']
+
+    # Retry next cycle, after breakerThreshold failures back off exponentially (flagging devices as timed out)
+    def pollFailed(self, udn, poll):
+        poll['failures'] += 1
+        backoff = self.pollInterval
+        if poll['failures'] >= self.breakerThreshold:
+            if poll['failures'] == self.breakerThreshold:
+                Domoticz.Error('WEMO udn='+udn+' is not responding, backing off')
+                self.timeoutDevices(udn)
+            backoff = min(self.pollInterval*2**(poll['failures']-self.breakerThreshold+1), self.breakerMaxBackoff)
+        poll['interval'] = self.pollInterval
+        poll['next'] = time.monotonic()+backoff
+
+    # Flag recent activity on udn so it gets polled often again
+    def markActive(self, udn):
+        wemo = self.wemos.get(udn, {})
+        now = time.monotonic()
+        wemo['lastchange'] = now
+        if 'poll' in wemo:
+            wemo['poll']['interval'] = self.pollInterval
+            wemo['poll']['next'] = min(wemo['poll']['next'], now+self.pollInterval)
+
+    # Subscribe to (or renew subscription of) the events of provided udn
+    def subscribeWEMO(self, udn):
+        try:
+            wemo = self.wemos[udn]
+            if 'subs' not in wemo:
+                wemo['subs'] = {}
+            service = 'bridge1' if udn.startswith('uuid:Bridge-') else 'basicevent1'
+            sub = wemo['subs'].get(service, {})
+            # Leave if subscription isn't expiring yet
+            if not self.subscriptionExpiring(udn):
+                return
+            url = wemo['location']+'/upnp/event/'+service
+            timeout = 'Second-'+str(self.subscriptionTimeout)
+            resp = {}
+            with self.subscribingCond:
+                self.subscribing.add(udn)
+            # Try to renew existing subscription first
+            if 'sid' in sub:
+                resp = doSUBSCRIBE(url, { 'SID' : sub['sid'], 'TIMEOUT' : timeout })
+            # New subscription (or renewal failed)
+            if 'sid' not in resp:
+                callback = 'http://'+localAddress(urlsplit(wemo['location']).hostname)+':'+str(self.eventPort)+'/'+udn
+                resp = doSUBSCRIBE(url, { 'CALLBACK' : '<'+callback+'>', 'NT' : 'upnp:event', 'TIMEOUT' : timeout })
+            if 'sid' in resp:
+                seconds = resp.get('timeout', timeout)
+                seconds = int(seconds[7:]) if seconds[7:].isdigit() else self.subscriptionTimeout
+                wemo['subs'][service] = { 'sid' : resp['sid'], 'expires' : time.monotonic()+seconds }
+                Domoticz.Debug('Subscribed to '+service+' events of udn='+udn+' sid='+resp['sid'])
+            else:
+                wemo['subs'].pop(service, None)
+                Domoticz.Debug('Unable to subscribe to '+service+' events of udn='+udn)
+
+        except Exception as err:
+            Domoticz.Error("subscribeWEMO: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+        finally:
+            with self.subscribingCond:
+                self.subscribing.discard(udn)
+                self.subscribingCond.notify_all()
+
+    # Check if sid is a current subscription of udn (waiting for a subscription of udn in progress)
+    def validSubscription(self, udn, sid):
+        wemo = self.wemos.get(udn)
+        if wemo is None:
+            return False
+        known = lambda: sid in [sub['sid'] for sub in list(wemo.get('subs', {}).values())]
+        with self.subscribingCond:
+            return self.subscribingCond.wait_for(lambda: known() or udn not in self.subscribing, self.subscribingWait) and known()
+
+    # Cancel event subscriptions of all WEMOs (in parallel, waiting up to timeout seconds) so they stop sending us events
+    def unsubscribeWEMOs(self, timeout):
+        try:
+            futures = []
+            for udn in list(self.wemos):
+                wemo = self.wemos.get(udn, {})
+                for service, sub in list(wemo.pop('subs', {}).items()):
+                    futures.append(self.relocatePool.submit(doUNSUBSCRIBE, wemo['location']+'/upnp/event/'+service, sub['sid']))
+                    Domoticz.Debug('Unsubscribing from '+service+' events of udn='+udn)
+            if len(futures) > 0:
+                wait(futures, timeout)
+
+        except Exception as err:
+            Domoticz.Error("unsubscribeWEMOs: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+
+    # Check if subscription of udn is missing or about to expire
+    def subscriptionExpiring(self, udn):
+        service = 'bridge1' if udn.startswith('uuid:Bridge-') else 'basicevent1'
+        sub = self.wemos[udn].get('subs', {}).get(service, {})
+        return sub.get('expires', 0)-time.monotonic() <= self.subscriptionRenew
+
+    # Check if WEMO has a valid subscription and has sent us events (so it does not need frequent polling)
+    def eventsFlowing(self, udn):
+        wemo = self.wemos[udn]
+        if 'lastevent' not in wemo or 'lastpoll' not in wemo or len(wemo.get('subs', {})) == 0:
+            return False
+        for service in wemo['subs']:
+            if wemo['subs'][service]['expires'] < time.monotonic():
+                return False
+        return True
+
+    # Apply event (NOTIFY body) received from provided udn for subscription sid, returns False (event ignored) if the udn is unknown
+    # or sid isn't one of its current subscriptions (anyone on the network can send a NOTIFY, old subscriptions may still send them)
+    def onEvent(self, udn, sid, body):
+        if not self.validSubscription(udn, sid):
+            Domoticz.Debug('Ignoring event from udn='+udn+' sid='+sid)
+            return False
+        try:
+            self.wemos[udn]['lastevent'] = time.monotonic()
+            self.extendWEMO(udn)
+            Domoticz.Debug('Event from udn='+udn+': '+body)
+
+            # If Wemo Link Bridge
+            if udn.startswith('uuid:Bridge-'):
+                # For each Link device state change
+                for event in getElements(body, 'StateEvent'):
+                    elems = parseElements(event, ('DeviceID', 'CapabilityId', 'Value'))
+                    devid = elems['DeviceID']
+                    capability = elems['CapabilityId']
+                    value = elems['Value']
+                    if len(devid) == 0 or len(capability) == 0 or len(value) == 0:
+                        continue
+                    unit = getUnit(devid[0])
+                    with devicesLock:
+                        # Group members (or deleted devices) are not in Domoticz
+                        state = shadow.get(unit)
+                        if state is None:
+                            continue
+                        nValue, sValue = state[0], state[1]
+                    # On/Off
+                    if capability[0] == '10006' and value[0] != '':
+                        nValue = 0 if value[0] == '0' else 2
+                    # Level (level:transition time)
+                    if capability[0] == '10008' and value[0] != '':
+                        sValue = str( round(int(value[0].split(':')[0])/2.55) )
+                    UpdateDevice(unit, nValue, sValue, 'available="NO"' in event)
+
+            # On/Off switch
+            else:
+                unit = getUnit(udn[udn.rfind('-')+1:])
+                for state in getElements(body, 'BinaryState'):
+                    state = state.split('|')[0]
+                    # Insight on standby (switched on without load)
+                    if state == '8':
+                        state = '1'
+                    if state == '0':
+                        UpdateDevice(unit, 0, 'Off', False)
+                    if state == '1':
+                        UpdateDevice(unit, 1, 'On', False)
+
+        except Exception as err:
+            Domoticz.Error("onEvent: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+        return True
+
+    # Get Link bridge devices/groups (adding new ones to Domoticz) and cache them, returns None if bridge didn't answer
+    def scanBridge(self, udn):
+        scan = doSOAP(self.wemos[udn]['location'], 'bridge', 'GetEndDevices', '<ReqListType>SCAN_LIST</ReqListType><DevUDN>'+udn+'</DevUDN>')
+        if scan == '':
+            return None
+        Domoticz.Debug('Scanning devices of udn='+udn)
+        elems = parseElements(scan, ('GroupInfo', 'GroupName', 'GroupID', 'FriendlyName', 'DeviceID'))
+
+        # Split group information
+        groupinfo = elems['GroupInfo']
+        # Get Groups and their IDs
+        groups = elems['GroupName']
+        groupIDs = elems['GroupID']
+        groupdevs = [[]]*len(groups)
+        allgroupdevs = set()
+        # For each group
+        for i in range(0, len(groups)):
+            Domoticz.Debug('grp='+groups[i]+' id='+groupIDs[i])
+            with devicesLock:
+                # See if it's already in Domoticz (and get unit # if so)
+                unit = getUnit(groupIDs[i])
+                # If it's not in Domoticz already
+                if unit == 0:
+                    # Not in Domoticz yet, add it in the next available unit number
+                    unit = nextUnit()
+                    # Add device as a dimmer switch
+                    Domoticz.Device(Name=groups[i], Unit=unit, Type=244, Subtype=73, Switchtype=7, Image=0, DeviceID=groupIDs[i]).Create()
+                    registry.add(unit, groupIDs[i])
+            # Get devices IDs associated with this group
+            groupdevs[i] = getElements(groupinfo[i], 'DeviceID')
+            Domoticz.Debug('groupdevs '+str(i)+'='+str(groupdevs[i]))
+            # Keep track of all devices that are pare of a group
+            allgroupdevs.update(groupdevs[i])
+        # Index group membership for this udn
+        registry.setGroups(udn, groupIDs, groupdevs)
+
+        # Get Individual LED devices and their IDs
+        leds = elems['FriendlyName']
+        ledIDs = elems['DeviceID']
+        for i in range(0, len(leds)):
+            Domoticz.Debug('led='+leds[i]+' id='+ledIDs[i])
+            with devicesLock:
+                # See if it's already in Domoticz (and get unit # if so)
+                unit = getUnit(ledIDs[i])
+                # If it's not in Domoticz already AND it is not part of a group
+                if unit == 0 and ledIDs[i] not in allgroupdevs:
+                    # Not in Domoticz yet, add it in the next available unit number
+                    unit = nextUnit()
+                    # Add device as a dimmer switch
+                    Domoticz.Device(Name=leds[i], Unit=unit, Type=244, Subtype=73, Switchtype=7, Image=0, DeviceID=ledIDs[i]).Create()
+                    registry.add(unit, ledIDs[i])
+
+        # Devices list is what the bridge has now (devices removed from it are flagged as timed out and no longer polled)
+        devices = list(collections.OrderedDict.fromkeys(groupIDs+ledIDs))
+        removed = [d for d in self.wemos[udn].get('devices', []) if d not in devices]
+        if len(removed) > 0:
+            Domoticz.Log('Devices '+', '.join(removed)+' are no longer paired with udn='+udn)
+            self.timeoutDevices(udn, { 'devices' : removed })
+        self.wemos[udn]['devices'] = devices
+        registry.setOwner(udn, devices)
+
+        # Cache topology
+        topology = { 'time' : time.monotonic(), 'groups' : dict([(groupIDs[i], set(groupdevs[i])) for i in range(0, len(groupIDs))]), 'ids' : set(devices) }
+        self.wemos[udn]['topology'] = topology
+        self.wemos[udn]['rescan'] = False
+        return topology
+
+    # Update WEMO information for provided udn, returns False if it didn't respond
     def updateWEMO(self, udn):
+        changed = False
         try:
             Domoticz.Debug('Updating '+self.wemos[udn]['location']+' udn='+udn)
 
             # If Wemo Link Bridge
             if udn.startswith('uuid:Bridge-'):
-                # Get LINK devices
-                headers={ 'Content-type' : 'text/xml; charset="utf-8"', 'SOAPACTION' : '"urn:Belkin:service:bridge:1#GetEndDevices"' }
-                data='<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:GetEndDevices xmlns:u="urn:Belkin:service:bridge:1"><ReqListType>SCAN_LIST</ReqListType><DevUDN>'+udn+'</DevUDN></u:GetEndDevices></s:Body></s:Envelope>'
-                scan = doPOST(self.wemos[udn]['location']+'/upnp/control/bridge1', data, headers)
-                scan = html.unescape(scan)
-
-                # Split group information
-                groupinfo = getElements(scan, 'GroupInfo')
-                # Get Groups and their IDs
-                groups = getElements(scan, 'GroupName')
-                groupIDs = getElements(scan, 'GroupID')
-                groupTimedOut = [False]*len(groups)
-                groupdevs = [[]]*len(groups)
-                allgroupdevs = []
-                # Save group ids for this udn
-                self.wemos[udn]['groupids'] = groupIDs
-                # For each group
-                for i in range(0, len(groups)):
-                    Domoticz.Debug('grp='+groups[i]+' id='+groupIDs[i])
-                    # See if it's already in Domoticz (and get unit # if so)
-                    unit = getUnit(groupIDs[i])
-                    # If it's not in Domoticz already
-                    if unit == 0:
-                        # Not in Domoticz yet, add it in the next available unit number
-                        unit = nextUnit()
-                        # Add device as a dimmer switch
-                        Domoticz.Device(Name=groups[i], Unit=unit, Type=244, Subtype=73, Switchtype=7, Image=0, DeviceID=groupIDs[i]).Create()
-                    # Get devices IDs associated with this group
-                    groupdevs[i] = getElements(groupinfo[i], 'DeviceID')
-                    Domoticz.Debug('groupdevs '+str(i)+'='+str(groupdevs[i]))
-                    # Keep track of all devices that are pare of a group
-                    allgroupdevs.extend(groupdevs[i])
-
-                # Get Individual LED devices and their IDs
-                leds = getElements(scan, 'FriendlyName')
-                ledIDs = getElements(scan, 'DeviceID')
-                for i in range(0, len(leds)):
-                    Domoticz.Debug('led='+leds[i]+' id='+ledIDs[i])
-                    # See if it's already in Domoticz (and get unit # if so)
-                    unit = getUnit(ledIDs[i])
-                    # If it's not in Domoticz already AND it is not part of a group
-                    if unit == 0 and ledIDs[i] not in allgroupdevs:
-                        # Not in Domoticz yet, add it in the next available unit number
-                        unit = nextUnit()
-                        # Add device as a dimmer switch
-                        Domoticz.Device(Name=leds[i], Unit=unit, Type=244, Subtype=73, Switchtype=7, Image=0, DeviceID=ledIDs[i]).Create()
-
-                # Initialize devices list if required
-                if 'devices' not in self.wemos[udn]:
-                    self.wemos[udn]['devices'] = []
-
-                # Make sure all group and LED IDs are in the devices list
-                self.wemos[udn]['devices'].extend( list( set(groupIDs)-set(self.wemos[udn]['devices']) ) )
-                self.wemos[udn]['devices'].extend( list( set(ledIDs)-set(self.wemos[udn]['devices']) ) )
-
-                # Get group+device status (all at once since ids is blank)
-                ids = str(self.wemos[udn]['devices']).replace('[', '').replace(']', '').replace('\'', '').replace(' ', '')
+                # Get LINK devices/groups if we don't know them yet, they're too old or the bridge re-announced itself
+                topology = self.wemos[udn].get('topology')
+                if topology is None or self.wemos[udn].get('rescan', False) or time.monotonic()-topology['time'] > self.topologyInterval:
+                    topology = self.scanBridge(udn)
+                    if topology is None or self.stopEvent.is_set():
+                        return False
+
+                # Get group+device status
+                ids = ','.join(self.wemos[udn]['devices'])
                 Domoticz.Debug("ids="+ids)
-                headers={ 'Content-type' : 'text/xml; charset="utf-8"', 'SOAPACTION' : '"urn:Belkin:service:bridge:1#GetDeviceStatus"' }
-                data='<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:GetDeviceStatus xmlns:u="urn:Belkin:service:bridge:1"><DeviceIDs>'+ids+'</DeviceIDs></u:GetDeviceStatus></s:Body></s:Envelope>'
-                state = doPOST(self.wemos[udn]['location']+'/upnp/control/bridge1', data, headers)
-                state = html.unescape(state)
+                state = doSOAP(self.wemos[udn]['location'], 'bridge', 'GetDeviceStatus', '<DeviceIDs>'+ids+'</DeviceIDs>')
+                if state == '':
+                    return False
+                elems = parseElements(state, ('CapabilityValue', 'DeviceID'))
 
-                # For each device ID/State
+                # For each device ID/State (use IDs from response when available)
                 stateids = self.wemos[udn]['devices']
-                states = getElements(state, 'CapabilityValue')
+                states = elems['CapabilityValue']
+                respids = elems['DeviceID']
+                if len(respids) == len(states):
+                    stateids = respids
+                groupTimedOut = set()
                 for i in range(0, len(states)):
                     # Get level information (second , delimited state)
                     level = states[i].split(',')[1]
                     Domoticz.Debug('id='+stateids[i]+' level='+level)
+                    group = registry.groupOf(stateids[i])
                     # If this device isn't part of a group
-                    if stateids[i] not in allgroupdevs and stateids[i] not in groupIDs:
+                    if group == '' and not registry.isGroup(stateids[i]):
                         unit = getUnit(stateids[i])
                         timedout = False
                         if level == '':
@@ -276,63 +1091,476 @@ class BasePlugin:
                         else:
                             level = level[0:level.rfind(':')]
                         level = str( round(int(level)/2.55) )
-                        UpdateDevice(unit, 0 if states[i][0:1] == '0' else 2, level, timedout)
+                        changed = UpdateDevice(unit, 0 if states[i][0:1] == '0' else 2, level, timedout) or changed
                     else:
-                        # If it's disconnected
-                        if level == '':
-                            # Find group 'g' this ID belongs to
-                            for g in range(0, len(groupIDs)):
-                                if stateids[i] in groupdevs[g]:
-                                    groupTimedOut[g] = True
-                                    break;
+                        # If it's disconnected, flag the group it belongs to
+                        if level == '' and group != '':
+                            groupTimedOut.add(group)
 
                 # For each group, update its device status
-                states = getElements(state, 'CapabilityValue')
-                for g in range(0, len(stateids)):
-                    if stateids[g] in groupIDs:
+                for g in range(0, len(states)):
+                    if registry.isGroup(stateids[g]):
                         level = states[g].split(',')[1]
                         level = level[0:level.rfind(':')]
                         level = str( (int(level)*100)//255 )
-                        UpdateDevice(getUnit(stateids[g]), 0 if states[g][0:1] == '0' else 2, level, groupTimedOut[g])
+                        changed = UpdateDevice(getUnit(stateids[g]), 0 if states[g][0:1] == '0' else 2, level, stateids[g] in groupTimedOut) or changed
 
             # On/Off switch
             else:
                 # Get device ID
                 devid = udn[udn.rfind('-')+1:]
+                # Insight switches also have energy (kWh) and power (Watt) devices
+                insight = udn.startswith('uuid:Insight-')
+                devids = [ devid, devid+'-kWh', devid+'-W' ] if insight else [ devid ]
                 # Make sure devices list is updated
-                self.wemos[udn]['devices'] = [ devid ]
+                self.wemos[udn]['devices'] = devids
+                registry.setOwner(udn, devids)
                 # See if it's already in Domoticz (and get unit # if so)
                 unit = getUnit(devid)
                 Domoticz.Debug('unit='+str(unit))
                 # If it's not in Domoticz already
-                if unit == 0:
-                    # Add it in the next available unit number
-                    unit = nextUnit()
+                if 0 in [getUnit(d) for d in devids]:
                     # Assume it's an on/off device
                     name = 'Switch'
-                    headers={ 'Content-type' : 'text/xml; charset="utf-8"', 'SOAPACTION' : '"urn:Belkin:service:basicevent:1#GetFriendlyName"' }
-                    data='<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:GetFriendlyName xmlns:u="urn:Belkin:service:basicevent:1"><FriendlyName></FriendlyName></u:GetFriendlyName></s:Body></s:Envelope>'
-                    scan = doPOST(self.wemos[udn]['location']+'/upnp/control/basicevent1', data, headers)
-                    scan = html.unescape(scan)
+                    scan = doSOAP(self.wemos[udn]['location'], 'basicevent', 'GetFriendlyName', '<FriendlyName></FriendlyName>')
                     name = getElements(scan, 'FriendlyName')[0]
                     Domoticz.Debug('name='+name)
-                    Domoticz.Device(Name=name, Unit=unit, Type=244, Subtype=73, Switchtype=0, Image=9, DeviceID=devid).Create()
-                # Get current status
-                headers={ 'Content-type' : 'text/xml; charset="utf-8"', 'SOAPACTION' : '"urn:Belkin:service:basicevent:1#GetBinaryState"' }
-                data='<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:GetBinaryState xmlns:u="urn:Belkin:service:basicevent:1"><BinaryState>1</BinaryState></u:GetBinaryState></s:Body></s:Envelope>'
-                state = doPOST(self.wemos[udn]['location']+'/upnp/control/basicevent1', data, headers)
-                if state != '':
-                    state = html.unescape(state)
-                    state = getElements(state, 'BinaryState')[0]
+                    with devicesLock:
+                        # Add it in the next available unit number (allocated only now, the name lookup above can take a while)
+                        unit = getUnit(devid)
+                        if unit == 0:
+                            unit = nextUnit()
+                            Domoticz.Device(Name=name, Unit=unit, Type=244, Subtype=73, Switchtype=0, Image=9, DeviceID=devid).Create()
+                            registry.add(unit, devid)
+                        if insight and getUnit(devid+'-kWh') == 0:
+                            kwh = nextUnit()
+                            Domoticz.Device(Name=name+' Energy', Unit=kwh, Type=243, Subtype=29, DeviceID=devid+'-kWh').Create()
+                            registry.add(kwh, devid+'-kWh')
+                        if insight and getUnit(devid+'-W') == 0:
+                            watt = nextUnit()
+                            Domoticz.Device(Name=name+' Power', Unit=watt, Type=248, Subtype=1, DeviceID=devid+'-W').Create()
+                            registry.add(watt, devid+'-W')
+                if self.stopEvent.is_set():
+                    return False
+                # Get current status (Insight gives state and energy usage in one call)
+                if insight:
+                    state = doSOAP(self.wemos[udn]['location'], 'insight', 'GetInsightParams', '<InsightParams></InsightParams>')
+                    if state != '':
+                        # state|lastchange|onfor|ontoday|ontotal|timeperiod|x|currentmW|todaymW*min|totalmW*min|threshold
+                        params = getElements(state, 'InsightParams')[0].split('|')
+                        state = params[0]
+                        power = round(float(params[7])/1000, 1)
+                        energy = round(float(params[9])/60000, 1)
+                        Domoticz.Debug('power='+str(power)+'W today='+str(round(float(params[8])/60000, 1))+'Wh ontoday='+params[3]+'s')
+                        UpdateDevice(getUnit(devid+'-W'), 0, str(power), False)
+                        UpdateDevice(getUnit(devid+'-kWh'), 0, str(power)+';'+str(energy), False)
+                else:
+                    state = doSOAP(self.wemos[udn]['location'], 'basicevent', 'GetBinaryState', '<BinaryState>1</BinaryState>')
+                    if state != '':
+                        state = getElements(state, 'BinaryState')[0].split('|')[0]
                 Domoticz.Debug('state='+state)
-                # Update domoticz status (On/Off and Timed out or not)
-                if state == '' or state == '0':
-                    UpdateDevice(unit, 0, 'Off', state == '')
+                # Insight on standby (switched on without load)
+                if state == '8':
+                    state = '1'
+                # No answer: leave the device alone (it is flagged as timed out once the WEMO fails breakerThreshold polls)
+                if state == '':
+                    return False
+                # Update domoticz status (On/Off)
+                if state == '0':
+                    changed = UpdateDevice(unit, 0, 'Off', False)
                 if state == '1':
-                    UpdateDevice(unit, 1, 'On', False)
+                    changed = UpdateDevice(unit, 1, 'On', False)
 
         except Exception as err:
             Domoticz.Error("updateWEMO: "+str(err)+' line '+format(sys.exc_info()[-1].tb_lineno))
+            stats.count('exceptions')
+            return False
+        finally:
+            if changed:
+                self.markActive(udn)
+        return True
+
+# HTTP handler for UPnP event NOTIFY requests sent by WEMOs (request path is the WEMO udn)
+class EventHandler(BaseHTTPRequestHandler):
+    def do_NOTIFY(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8', 'replace')
+        known = _plugin.onEvent(self.path.lstrip('/'), self.headers.get('SID', ''), body)
+        self.send_response(200 if known else 412)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        Domoticz.Debug("EventHandler: "+(format % args))
+
+# Event server handling each NOTIFY in its own thread
+class EventServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    # WEMOs send their events at the same time (scenes, groups) and connections that don't fit the listen queue are retried a second later,
+    # so make room for one from each WEMO a hardware entry can hold
+    request_queue_size = 256
+
+# Pool of keep-alive HTTP connections to WEMOs (by location), thread safe
+class ConnectionPool:
+    def __init__(self, maxPerHost=2, timeout=2.0):
+        self.maxPerHost = maxPerHost
+        self.timeout = timeout
+        # Idle connections, connections in use and pool generation (bumped when dropped) for each location
+        self.idle = {}
+        self.busy = {}
+        self.generation = {}
+        # Connections handed out (so closeAll can interrupt their requests) and whether new requests are refused
+        self.inuse = set()
+        self.closed = False
+        # Counters: connections reused, new connections and reconnects of stale connections
+        self.hits = 0
+        self.created = 0
+        self.reconnects = 0
+        self.cond = threading.Condition()
+
+    # Send HTTP request, returns (status, headers with lowercase names, content)
+    def request(self, method, url, body=None, headers={}):
+        u = urlsplit(url)
+        location = u.scheme+'://'+u.netloc
+        path = u.path + ('?'+u.query if u.query != '' else '')
+        conn, reused = self.acquire(location)
+        try:
+            try:
+                resp = self.send(conn, method, path, body, headers)
+            except (http.client.BadStatusLine, ConnectionError):
+                if not reused or self.closed:
+                    raise
+                # Stale keep-alive connection (closed by the WEMO), reconnect and retry once
+                with self.cond:
+                    self.reconnects += 1
+                conn.close()
+                resp = self.send(conn, method, path, body, headers)
+            content = resp.read()
+        except:
+            self.release(location, conn, False)
+            raise
+        self.release(location, conn, not resp.will_close)
+        return resp.status, dict([(k.lower(), v) for k, v in resp.getheaders()]), content
+
+    def send(self, conn, method, path, body, headers):
+        conn.request(method, path, body, headers)
+        return conn.getresponse()
+
+    # Get idle connection to location (or a new one if we are under the limit), returns (connection, reused)
+    def acquire(self, location):
+        with self.cond:
+            while not self.closed and len(self.idle.get(location, [])) == 0 and self.busy.get(location, 0) >= self.maxPerHost:
+                if not self.cond.wait(self.timeout):
+                    raise socket.timeout('No connection available to '+location)
+            if self.closed:
+                raise ConnectionAbortedError('Connection pool closed')
+            self.busy[location] = self.busy.get(location, 0)+1
+            if len(self.idle.get(location, [])) > 0:
+                self.hits += 1
+                conn = self.idle[location].pop()
+                self.inuse.add(conn)
+                return conn, True
+            self.created += 1
+            u = urlsplit(location)
+            conn = http.client.HTTPConnection(u.hostname, u.port, timeout=self.timeout)
+            conn.generation = self.generation.get(location, 0)
+            self.inuse.add(conn)
+        return conn, False
+
+    # Return connection to the pool (closing it if it can't be reused or its location was dropped)
+    def release(self, location, conn, reuse):
+        with self.cond:
+            self.busy[location] = self.busy.get(location, 1)-1
+            self.inuse.discard(conn)
+            if reuse and not self.closed and conn.generation == self.generation.get(location, 0):
+                self.idle.setdefault(location, []).append(conn)
+            else:
+                conn.close()
+            self.cond.notify_all()
+
+    # Close all connections to location (i.e. WEMO moved to a different location)
+    def drop(self, location):
+        with self.cond:
+            self.generation[location] = self.generation.get(location, 0)+1
+            for conn in self.idle.pop(location, []):
+                conn.close()
+
+    # Close all connections, interrupting requests in progress, and refuse new requests until reopened (plugin stopping)
+    def closeAll(self):
+        with self.cond:
+            self.closed = True
+            for location in set(self.idle) | set(self.busy):
+                self.drop(location)
+            for conn in self.inuse:
+                if conn.sock is not None:
+                    try:
+                        conn.sock.shutdown(socket.SHUT_RDWR)
+                    except OSError:
+                        pass
+            self.cond.notify_all()
+
+    def open(self):
+        with self.cond:
+            self.closed = False
+
+    def stats(self):
+        with self.cond:
+            return { 'hits' : self.hits, 'created' : self.created, 'reconnects' : self.reconnects, 'idle' : sum([len(c) for c in self.idle.values()]) }
+
+global connections
+connections = ConnectionPool()
+
+# Latency histogram (counts by bucket, total and maximum in seconds)
+class Histogram:
+    # Upper bounds (s) of the buckets, last bucket takes anything slower
+    bounds = (0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.0)
+
+    def __init__(self):
+        self.buckets = [0]*(len(self.bounds)+1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other):
+        for i in range(0, len(self.buckets)):
+            self.buckets[i] += other.buckets[i]
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def average(self):
+        return self.total/self.count if self.count > 0 else 0.0
+
+    # Upper bound of bucket holding the given fraction of samples
+    def percentile(self, fraction):
+        seen = 0
+        for i in range(0, len(self.bounds)):
+            seen += self.buckets[i]
+            if seen >= self.count*fraction:
+                return '<'+str(round(self.bounds[i]*1000))+'ms'
+        return '>'+str(round(self.bounds[-1]*1000))+'ms'
+
+    def describe(self):
+        if self.count == 0:
+            return 'none'
+        return str(self.count)+' avg '+str(round(self.average()*1000))+'ms p90 '+self.percentile(0.9)+' max '+str(round(self.max*1000))+'ms'
+
+# Counters and latency histograms collected between statistics reports (cheap enough to always be on)
+class Statistics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+        self.timings = {}
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    # Add latency sample to histogram key (cycle, discovery or (location, SOAP action) of requests)
+    def timing(self, key, seconds):
+        with self.lock:
+            if key not in self.timings:
+                self.timings[key] = Histogram()
+            self.timings[key].add(seconds)
+
+    # Get counters and histograms collected since last call (and start over)
+    def take(self):
+        with self.lock:
+            counters, timings = self.counters, self.timings
+            self.counters = collections.Counter()
+            self.timings = {}
+        return counters, timings
+
+global stats
+stats = Statistics()
+
+# Last state written to each Domoticz device (so updates are checked without reading devices from Domoticz) and
+# updates deferred by poll workers until the end of the poll cycle in which their WEMO finished polling (only the last one of each device is written)
+class DeviceStates:
+    # Log at most logLimit updates of each device every logWindow seconds (devices flapping on and off)
+    logLimit = 5
+    logWindow = 600
+
+    def __init__(self):
+        self.states = {}
+        self.pending = collections.OrderedDict()
+        self.logs = {}
+        self.local = threading.local()
+
+    def rebuild(self):
+        with devicesLock:
+            self.states = dict([(u, (Devices[u].nValue, Devices[u].sValue, Devices[u].TimedOut)) for u in Devices])
+            self.pending.clear()
+            self.logs.clear()
+
+    # Forget Domoticz device removed by the user
+    def remove(self, unit):
+        with devicesLock:
+            self.states.pop(unit, None)
+            self.pending.pop(unit, None)
+            self.logs.pop(unit, None)
+
+    # Current (nValue, sValue, TimedOut) of unit, including updates not written yet (None if there's no such device)
+    def get(self, unit):
+        with devicesLock:
+            if unit in self.pending:
+                return self.pending[unit][1]
+            if unit not in self.states:
+                # Device created since rebuild
+                if unit not in Devices:
+                    return None
+                self.states[unit] = (Devices[unit].nValue, Devices[unit].sValue, Devices[unit].TimedOut)
+            return self.states[unit]
+
+    # Defer updates made by the calling thread (polling udn) until flush, or write them right away if udn is blank
+    def defer(self, udn):
+        self.local.udn = udn
+
+    def update(self, unit, nValue, sValue, TimedOut):
+        stats.count('updates')
+        state = (nValue, str(sValue), TimedOut)
+        with devicesLock:
+            current = self.get(unit)
+            if current is None or current == state:
+                return False
+            udn = getattr(self.local, 'udn', '')
+            if udn != '':
+                self.pending[unit] = (udn, state)
+                # Changed back to what Domoticz already has
+                if self.states.get(unit) == state:
+                    del self.pending[unit]
+            else:
+                self.pending.pop(unit, None)
+                self.write(unit, state)
+        return True
+
+    # Write deferred updates (except those of udns in busy, their poll isn't finished)
+    def flush(self, busy=()):
+        with devicesLock:
+            for unit in [u for u in self.pending if self.pending[u][0] not in busy]:
+                self.write(unit, self.pending.pop(unit)[1])
+
+    def write(self, unit, state):
+        # Make sure that the Domoticz device still exists (they can be deleted) before updating it
+        if unit not in Devices:
+            self.states.pop(unit, None)
+            return
+        Devices[unit].Update(nValue=state[0], sValue=state[1], TimedOut=state[2])
+        self.states[unit] = state
+        stats.count('writes')
+        message = "Update "+str(state[0])+":'"+state[1]+"' ("+Devices[unit].Name+") TimedOut="+str(state[2])
+        # Statistics devices change on every report, their updates are only logged when debugging
+        if Devices[unit].DeviceID.startswith('stats-'):
+            Domoticz.Debug(message)
+            return
+        # Count updates logged in current window of this device
+        now = time.monotonic()
+        log = self.logs.get(unit)
+        if log is None or now-log[0] >= self.logWindow:
+            if log is not None and log[2] > 0:
+                Domoticz.Log(str(log[2])+" more updates of ("+Devices[unit].Name+") were not logged")
+            log = self.logs[unit] = [now, 0, 0]
+        if log[1] < self.logLimit:
+            log[1] += 1
+            Domoticz.Log(message)
+        else:
+            log[2] += 1
+            Domoticz.Debug(message)
+
+global shadow
+shadow = DeviceStates()
+
+# Indexes of devices: DeviceID to Domoticz Unit, DeviceID to owning WEMO udn, Link group membership and free Units
+class DeviceRegistry:
+    def __init__(self):
+        self.units = {}
+        self.owners = {}
+        # Link group DeviceID to its member DeviceIDs, member DeviceID to its group DeviceID and bridge udn to its group DeviceIDs
+        self.groups = {}
+        self.members = {}
+        self.bridgeGroups = {}
+        # Heap of unit numbers not used by Domoticz devices
+        self.free = []
+
+    # Rebuild Domoticz indexes from Devices (done on start)
+    def rebuild(self):
+        with devicesLock:
+            self.units = dict([(Devices[x].DeviceID, x) for x in Devices])
+            self.free = [x for x in range(1, 256) if x not in Devices]
+            heapq.heapify(self.free)
+
+    # Register Domoticz device just created
+    def add(self, unit, devid):
+        with devicesLock:
+            self.units[devid] = unit
+
+    # Forget Domoticz device removed by the user
+    def remove(self, unit):
+        with devicesLock:
+            for devid in [d for d in self.units if self.units[d] == unit]:
+                del self.units[devid]
+            heapq.heappush(self.free, unit)
+
+    # Unit number for DeviceID (zero if not in Domoticz)
+    def unit(self, devid):
+        with devicesLock:
+            unit = self.units.get(devid, 0)
+            # Reconcile index if device was deleted (or replaced) without us being told
+            if unit != 0 and (unit not in Devices or Devices[unit].DeviceID != devid):
+                del self.units[devid]
+                if unit not in Devices:
+                    heapq.heappush(self.free, unit)
+                unit = 0
+            return unit
+
+    # Smallest unit number available to add a device in domoticz
+    def nextUnit(self):
+        with devicesLock:
+            # Discard units taken since they were freed
+            while len(self.free) > 0 and self.free[0] in Devices:
+                heapq.heappop(self.free)
+            # Units freed without us being told
+            if len(self.free) == 0:
+                self.free = [x for x in range(1, 256) if x not in Devices]
+            return self.free[0] if len(self.free) > 0 else 255
+
+    # Replace DeviceIDs owned by udn
+    def setOwner(self, udn, devids):
+        with devicesLock:
+            for devid in [d for d in self.owners if self.owners[d] == udn and d not in devids]:
+                del self.owners[devid]
+            for devid in devids:
+                self.owners[devid] = udn
+
+    def owner(self, devid):
+        return self.owners.get(devid, '')
+
+    # Replace group information of bridge udn
+    def setGroups(self, udn, groupIDs, groupdevs):
+        with devicesLock:
+            for group in self.bridgeGroups.pop(udn, []):
+                for devid in self.groups.pop(group, []):
+                    self.members.pop(devid, None)
+            self.bridgeGroups[udn] = set(groupIDs)
+            for i in range(0, len(groupIDs)):
+                self.groups[groupIDs[i]] = set(groupdevs[i])
+                for devid in groupdevs[i]:
+                    self.members[devid] = groupIDs[i]
+
+    def isGroup(self, devid):
+        return devid in self.groups
+
+    # Group DeviceID the Link device belongs to (blank if none)
+    def groupOf(self, devid):
+        return self.members.get(devid, '')
+
+global registry
+registry = DeviceRegistry()
 
 global _plugin
 _plugin = BasePlugin()
@@ -357,6 +1585,10 @@ def onCommand(Unit, Command, Level, Hue):
     global _plugin
     _plugin.onCommand(Unit, Command, Level, Hue)
 
+def onDeviceRemoved(Unit):
+    global _plugin
+    _plugin.onDeviceRemoved(Unit)
+
 def onNotification(Name, Subject, Text, Status, Priority, Sound, ImageFile):
     global _plugin
     _plugin.onNotification(Name, Subject, Text, Status, Priority, Sound, ImageFile)
@@ -384,46 +1616,156 @@ def DumpConfigToLog():
         Domoticz.Debug("Device LastLevel: " + str(Devices[x].LastLevel))
     return
 
-# Basic XML Element reader without imports
-def getElements(data, tag):
-    elems = []
-    start = 0
-    start = data.find('<'+tag+'>', start)
-    while start > 0:
-        end = data.find('</'+tag+'>', start+len(tag))
-        elems.append(data[start+len(tag)+2:end])
-        start = data.find('<'+tag+'>', start+len(tag))
+# Compiled patterns matching open/close tags of a set of elements (by tuple of tags)
+elementPatterns = {}
+
+# Single pass XML element reader: finds all wanted tags at once, as plain or entity escaped XML (as embedded in SOAP responses)
+# and returns dict of tag to list of unescaped element contents (elements may have attributes)
+def parseElements(data, tags):
+    pattern = elementPatterns.get(tags)
+    if pattern is None:
+        pattern = re.compile('(?:<|&lt;)(/?)('+'|'.join(tags)+')(?=[\\s/>]|&gt;)[^<>]*?(/?)(?:>|&gt;)')
+        elementPatterns[tags] = pattern
+    elems = dict([(tag, []) for tag in tags])
+    opened = {}
+    for m in pattern.finditer(data):
+        tag = m.group(2)
+        # Closing tag
+        if m.group(1) == '/':
+            start = opened.pop(tag, None)
+            if start is not None:
+                value = data[start:m.start()]
+                elems[tag].append(html.unescape(value) if '&' in value else value)
+        # Empty element
+        elif m.group(3) == '/':
+            elems[tag].append('')
+        else:
+            opened[tag] = m.end()
     return elems
 
-# Simple POST method (used in separate thread to prevent Domoticz blocking)
+# Basic XML Element reader for a single tag
+def getElements(data, tag):
+    return parseElements(data, (tag,))[tag]
+
+# Parse SSDP message headers (names in uppercase)
+def parseSSDP(data):
+    headers = {}
+    for line in data.splitlines():
+        if ':' in line:
+            name, value = line.split(':', 1)
+            headers[name.strip().upper()] = value.strip()
+    return headers
+
+# Build SOAP request for service action: (control path, headers, envelope start, envelope end) with envelope as encoded bytes
+def buildEnvelope(service, action):
+    urn = 'urn:Belkin:service:'+service+':1'
+    headers = { 'Content-type' : 'text/xml; charset="utf-8"', 'SOAPACTION' : '"'+urn+'#'+action+'"' }
+    start = '<?xml version="1.0" encoding="utf-8"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:'+action+' xmlns:u="'+urn+'">'
+    end = '</u:'+action+'></s:Body></s:Envelope>'
+    return ('/upnp/control/'+service+'1', headers, start.encode('utf-8'), end.encode('utf-8'))
+
+# Prebuilt SOAP requests by (service, action)
+global envelopes
+envelopes = dict([((service, action), buildEnvelope(service, action)) for service, action in [
+    ('basicevent', 'GetBinaryState'), ('basicevent', 'SetBinaryState'), ('basicevent', 'GetFriendlyName'),
+    ('bridge', 'GetEndDevices'), ('bridge', 'GetDeviceStatus'), ('bridge', 'SetDeviceStatus'),
+    ('insight', 'GetInsightParams') ]])
+
+# Send SOAP action to WEMO at location (args is the XML inside the action element), returns response ('' if it failed)
+def doSOAP(location, service, action, args):
+    path, headers, start, end = envelopes[(service, action)]
+    return doPOST(location+path, start+args.encode('utf-8')+end, headers)
+
+# Simple POST method over pooled keep-alive connections (used in separate thread to prevent Domoticz blocking)
 def doPOST(url, data, headers):
-    http = Http(cache=None, timeout=2.0)
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    # Latency is tracked by location and SOAP action
+    key = (url[:url.find('/', 8)], headers.get('SOAPACTION', '').strip('"').split('#')[-1])
+    start = time.monotonic()
     try:
-        resp, content = http.request(uri=url, method='POST', headers=headers, body=data)
+        status, resp, content = connections.request('POST', url, data, headers)
+    except socket.timeout:
+        stats.count('timeouts')
+        return ''
     except:
+        stats.count('errors')
         return ''
+    finally:
+        stats.timing(key, time.monotonic()-start)
+    if status != 200:
+        stats.count('errors')
     return content.decode('utf-8')
 
-# Loop thru domoticz devices and see if there's a device with matching DeviceID, if so, return unit number, otherwise return zero
+# Send GENA SUBSCRIBE request, returns response headers (empty if it failed)
+def doSUBSCRIBE(url, headers):
+    try:
+        status, resp, content = connections.request('SUBSCRIBE', url, None, headers)
+    except:
+        return {}
+    if status != 200:
+        return {}
+    return resp
+
+# Send GENA UNSUBSCRIBE request for subscription sid, returns True if the WEMO accepted it
+def doUNSUBSCRIBE(url, sid):
+    try:
+        status, resp, content = connections.request('UNSUBSCRIBE', url, None, { 'SID' : sid })
+    except:
+        return False
+    return status == 200
+
+# Shut down worker pool waiting for running work to finish (work not started yet is dropped)
+def stopPool(pool):
+    if pool is None:
+        return
+    try:
+        pool.shutdown(wait=True, cancel_futures=True)
+    except TypeError:
+        # Python < 3.9 can't cancel queued work, workers return right away as they check for stop requests
+        pool.shutdown(wait=True)
+
+# Check if WEMO at location is the one with provided udn (by reading its setup.xml)
+def probeSetup(location, udn):
+    # Not using the connection pool as most probed locations are wrong (and we want a short timeout)
+    u = urlsplit(location)
+    conn = http.client.HTTPConnection(u.hostname, u.port, timeout=1.0)
+    try:
+        conn.request('GET', '/setup.xml')
+        resp = conn.getresponse()
+        content = resp.read()
+    except:
+        return False
+    finally:
+        conn.close()
+    return resp.status == 200 and udn in getElements(content.decode('utf-8', 'replace'), 'UDN')
+
+# Check if WEMO at location accepts connections (cheap probe for WEMOs that stopped responding)
+def probeWEMO(location):
+    u = urlsplit(location)
+    try:
+        socket.create_connection((u.hostname, u.port), timeout=0.5).close()
+    except:
+        return False
+    return True
+
+# Find local IP address used to reach provided host (to tell WEMOs where to send events)
+def localAddress(host):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        s.connect((host, 1900))
+        return s.getsockname()[0]
+    finally:
+        s.close()
+
+# Look up domoticz device with matching DeviceID, if found return unit number, otherwise return zero
 def getUnit(devid):
-    unit = 0
-    for x in Devices:
-        if Devices[x].DeviceID == devid:
-            unit = x
-            break
-    return unit
+    return registry.unit(devid)
 
 # Find the smallest unit number available to add a device in domoticz
 def nextUnit():
-    unit = 1
-    while unit in Devices and unit < 255:
-        unit = unit + 1
-    return unit
+    return registry.nextUnit()
 
+# Update device if its state changed, returns True if it did (poll workers only write it at the end of the poll cycle)
 def UpdateDevice(Unit, nValue, sValue, TimedOut):
-    # Make sure that the Domoticz device still exists (they can be deleted) before updating it
-    if (Unit in Devices):
-        if (Devices[Unit].nValue != nValue) or (Devices[Unit].sValue != sValue) or (Devices[Unit].TimedOut != TimedOut):
-            Devices[Unit].Update(nValue=nValue, sValue=str(sValue), TimedOut=TimedOut)
-            Domoticz.Log("Update "+str(nValue)+":'"+str(sValue)+"' ("+Devices[Unit].Name+") TimedOut="+str(TimedOut))
-    return
+    return shadow.update(Unit, nValue, sValue, TimedOut)
@@ -0,0 +1,138 @@
+# WEMO plugin benchmark
+#
+# Runs the plugin (with a stub Domoticz) against simulated fleets of increasing size and reports, for each size:
+# time until all devices exist, poll cycle time, requests and CPU per cycle, onCommand call time, time to deliver
+# the commands, time until changes made outside Domoticz show up, updateWEMO time and memory. With --events the plugin subscribes to
+# WEMO events (the simulator sends them on every change) and the event subscriptions left after onStop are reported.
+#
+#   python3 tools/benchmark.py --sizes 10,100,250 --latency 0.02 --loss 0.01 --dead 2
+#   python3 tools/benchmark.py --sizes 10,100 --events
+#
+# Sizes are Domoticz devices (a Domoticz hardware entry holds at most 255), half of them switches and the rest Link
+# bulbs/groups on bridges.
+#
+import sys
+import os
+import time
+import shutil
+import tempfile
+import argparse
+import importlib
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import wemosim
+
+# Wait until condition is met (or timeout), returns seconds waited
+def waitFor(condition, timeout):
+    start = time.monotonic()
+    while not condition() and time.monotonic()-start < timeout:
+        time.sleep(0.01)
+    return time.monotonic()-start
+
+# Split device count in switches and bridges (each bridge has bulbs-perGroup*groups bulbs plus its groups)
+def composition(size, bulbs, groups, perGroup):
+    perBridge = bulbs-perGroup*groups+groups
+    bridges = (size//2)//perBridge
+    return size-bridges*perBridge, bridges
+
+def benchmark(size, args):
+    switches, bridges = composition(size, args.bulbs, args.groups, args.per_group)
+    fleet = wemosim.FleetProcess(ssdp=args.ssdp, switches=switches, bridges=bridges, bulbs=args.bulbs, groups=args.groups,
+        perGroup=args.per_group, dead=args.dead, latency=args.latency, loss=args.loss).start()
+    home = tempfile.mkdtemp()
+    Domoticz = wemosim.installDomoticz(args.verbose)
+    import plugin
+    plugin = importlib.reload(plugin)
+    plugin.Devices = Domoticz.Devices
+    plugin.Parameters = { 'Mode1' : str(args.workers), 'Mode2' : str(args.interval), 'Mode3' : '86400', 'Mode4' : '1' if args.events else '0', 'Port' : str(args.port),
+        'Mode5' : '0', 'Mode6' : '0', 'HomeFolder' : home+'/' }
+    results = { 'size' : size, 'wemos' : len(fleet.wemos) }
+    try:
+        # Discovery: seed WEMOs (or let the plugin find them over SSDP) and wait for all devices to be created and updated
+        if not args.ssdp:
+            for udn, location in fleet.wemos:
+                plugin._plugin.wemos[udn] = { 'location' : location }
+        plugin.onStart()
+        expected = fleet.devices-args.dead
+        results['startup'] = waitFor(lambda: len(plugin.Devices) >= expected and min([d.updates for d in list(plugin.Devices.values())]) > 0, 60)
+
+        # Poll cycles
+        plugin.stats.take()
+        requests = fleet.requests()
+        cpu = time.process_time()
+        time.sleep(args.cycles*args.interval)
+        cpu = time.process_time()-cpu
+        counters, timings = plugin.stats.take()
+        cycles = timings.get('cycle', plugin.Histogram())
+        results['cycle'] = cycles.average()
+        results['cyclemax'] = cycles.max
+        results['overruns'] = counters['overruns']
+        results['requests'] = (fleet.requests()-requests)/max(1, cycles.count)
+        results['cpu'] = cpu/max(1, cycles.count)
+        results['writes'] = counters['writes']
+
+        # Commands: time spent in onCommand (blocking Domoticz) and until they were all sent
+        units = [u for u in plugin.Devices if plugin.registry.owner(plugin.Devices[u].DeviceID) != '']
+        start = time.perf_counter()
+        for unit in units:
+            plugin.onCommand(unit, 'On', 0, 0)
+        results['oncommand'] = (time.perf_counter()-start)/max(1, len(units))
+        results['commands'] = waitFor(lambda: len(plugin._plugin.commands) == 0 and len(plugin._plugin.commandUDNs) == 0, 60)
+
+        # Changes made outside Domoticz: switch everything off in the simulator and wait until Domoticz shows it (polled or pushed)
+        results['subs'] = fleet.subscriptions()
+        fleet.setAll('0')
+        results['external'] = waitFor(lambda: len([u for u in units if plugin.Devices[u].nValue != 0]) == 0, 60)
+        plugin.onStop()
+        results['left'] = fleet.subscriptions()
+
+        # Update of each WEMO, one at a time (memory measured over all of them), with requests allowed again
+        live = [udn for udn, location in fleet.wemos[:len(fleet.wemos)-args.dead]]
+        plugin._plugin.stopEvent.clear()
+        plugin.connections.open()
+        tracemalloc.start()
+        start = time.perf_counter()
+        for udn in live:
+            plugin._plugin.updateWEMO(udn)
+        results['update'] = (time.perf_counter()-start)/max(1, len(live))
+        results['memory'] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        results['errors'] = len([m for m in Domoticz.messages if m[0] == 'Error'])
+    finally:
+        plugin._plugin.stopEvent.set()
+        plugin.connections.closeAll()
+        fleet.stop()
+        shutil.rmtree(home, ignore_errors=True)
+    return results
+
+def report(results):
+    print('%6s %6s %9s %9s %9s %8s %9s %9s %10s %9s %9s %5s %5s %9s %9s %8s %7s' % ('size', 'wemos', 'startup', 'cycle', 'cyclemax', 'overrun', 'req/cyc',
+        'cpu/cyc', 'oncommand', 'commands', 'external', 'subs', 'left', 'update', 'memory', 'writes', 'errors'))
+    for r in results:
+        print('%6d %6d %8.2fs %7.1fms %7.1fms %8d %9.1f %7.1fms %8.1fus %8.2fs %8.2fs %5d %5d %7.1fms %7.0fKB %8d %7d' % (r['size'], r['wemos'],
+            r['startup'], r['cycle']*1000, r['cyclemax']*1000, r['overruns'], r['requests'], r['cpu']*1000, r['oncommand']*1000000, r['commands'],
+            r['external'], r['subs'], r['left'], r['update']*1000, r['memory']/1024, r['writes'], r['errors']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the WEMO plugin against simulated fleets')
+    parser.add_argument('--sizes', default='10,100,250', help='comma separated device counts (at most 255)')
+    parser.add_argument('--cycles', type=int, default=5, help='poll cycles measured for each size')
+    parser.add_argument('--interval', type=int, default=2, help='poll interval (s)')
+    parser.add_argument('--workers', type=int, default=8, help='poll workers')
+    parser.add_argument('--bulbs', type=int, default=8, help='bulbs per bridge')
+    parser.add_argument('--groups', type=int, default=1, help='groups per bridge')
+    parser.add_argument('--per-group', type=int, default=2, help='bulbs per group')
+    parser.add_argument('--dead', type=int, default=0, help='WEMOs announced but refusing connections')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each request')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of requests/SSDP answers dropped')
+    parser.add_argument('--ssdp', action='store_true', help='discover the fleet over SSDP instead of seeding it')
+    parser.add_argument('--events', action='store_true', help='enable event subscriptions')
+    parser.add_argument('--port', type=int, default=8900, help='port the plugin listens on for events')
+    parser.add_argument('--verbose', action='store_true', help='print plugin log')
+    args = parser.parse_args()
+    sizes = [int(s) for s in args.sizes.split(',')]
+    if max(sizes) > 255:
+        parser.error('a Domoticz hardware entry holds at most 255 devices')
+    report([benchmark(size, args) for size in sizes])
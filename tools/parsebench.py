@@ -0,0 +1,106 @@
+# SOAP parsing/envelope micro-benchmark
+#
+# Compares, on the responses of a simulated Link bridge, how the plugin used to read them (html.unescape of the whole response and
+# one getElements scan per tag) with parseElements (one pass, only returned values unescaped), and building request envelopes
+# from scratch with the prebuilt ones used by doSOAP. Reports time per call and peak memory allocated (tracemalloc).
+#
+#   python3 tools/parsebench.py --bulbs 66 --groups 6
+#
+import sys
+import os
+import time
+import html
+import argparse
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import wemosim
+
+# getElements before parseElements (works on unescaped data only)
+def oldGetElements(data, tag):
+    elems = []
+    start = data.find('<'+tag)
+    while start >= 0:
+        close = data.find('>', start)
+        if close < 0:
+            break
+        # Skip other tags starting with the same name (i.e. DeviceIDs when looking for DeviceID)
+        if data[start+len(tag)+1] in '> /':
+            if data[close-1] == '/':
+                elems.append('')
+            else:
+                end = data.find('</'+tag+'>', close)
+                if end < 0:
+                    break
+                elems.append(data[close+1:end])
+                close = end
+        start = data.find('<'+tag, close)
+    return elems
+
+# Bridge scan (GetEndDevices) and status (GetDeviceStatus) as read by scanBridge/updateWEMO before and after
+def oldScan(scan):
+    scan = html.unescape(scan)
+    groupdevs = [oldGetElements(info, 'DeviceID') for info in oldGetElements(scan, 'GroupInfo')]
+    return (oldGetElements(scan, 'GroupName'), oldGetElements(scan, 'GroupID'), groupdevs, oldGetElements(scan, 'FriendlyName'), oldGetElements(scan, 'DeviceID'))
+
+def newScan(scan):
+    elems = plugin.parseElements(scan, ('GroupInfo', 'GroupName', 'GroupID', 'FriendlyName', 'DeviceID'))
+    groupdevs = [plugin.getElements(info, 'DeviceID') for info in elems['GroupInfo']]
+    return (elems['GroupName'], elems['GroupID'], groupdevs, elems['FriendlyName'], elems['DeviceID'])
+
+def oldStatus(state):
+    state = html.unescape(state)
+    return (oldGetElements(state, 'CapabilityValue'), oldGetElements(state, 'DeviceID'))
+
+def newStatus(state):
+    elems = plugin.parseElements(state, ('CapabilityValue', 'DeviceID'))
+    return (elems['CapabilityValue'], elems['DeviceID'])
+
+# GetDeviceStatus request as built before (whole envelope concatenated and encoded each time) and with doSOAP's prebuilt one
+def oldEnvelope(ids):
+    headers = { 'Content-type' : 'text/xml; charset="utf-8"', 'SOAPACTION' : '"urn:Belkin:service:bridge:1#GetDeviceStatus"' }
+    data = '<?xml version="1.0"?><s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body><u:GetDeviceStatus xmlns:u="urn:Belkin:service:bridge:1"><DeviceIDs>'+ids+'</DeviceIDs></u:GetDeviceStatus></s:Body></s:Envelope>'
+    return (headers, data.encode('utf-8'))
+
+def newEnvelope(ids):
+    path, headers, start, end = plugin.envelopes[('bridge', 'GetDeviceStatus')]
+    return (headers, start+('<DeviceIDs>'+ids+'</DeviceIDs>').encode('utf-8')+end)
+
+# Seconds per call and peak bytes allocated by one call
+def measure(function, arg, repeat):
+    function(arg)
+    start = time.perf_counter()
+    for i in range(0, repeat):
+        function(arg)
+    elapsed = (time.perf_counter()-start)/repeat
+    tracemalloc.start()
+    function(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark SOAP response parsing and request envelopes of the WEMO plugin')
+    parser.add_argument('--bulbs', type=int, default=66, help='bulbs on the bridge')
+    parser.add_argument('--groups', type=int, default=6, help='groups on the bridge')
+    parser.add_argument('--per-group', type=int, default=4, help='bulbs per group')
+    parser.add_argument('--repeat', type=int, default=1000, help='calls measured')
+    args = parser.parse_args()
+
+    wemosim.installDomoticz()
+    import plugin
+    bridge = wemosim.Bridge(0, args.bulbs, args.groups, args.per_group)
+    scan = wemosim.envelope(bridge.soap('GetEndDevices', '')).decode('utf-8')
+    state = wemosim.envelope(bridge.soap('GetDeviceStatus', '<DeviceIDs>'+','.join(bridge.bulbs)+'</DeviceIDs>')).decode('utf-8')
+    ids = ','.join(bridge.bulbs)
+    if oldScan(scan) != newScan(scan) or oldStatus(state) != newStatus(state):
+        sys.exit('parseElements and the old parser disagree')
+
+    print('%d bulbs, %d groups: scan %.1fKB, status %.1fKB' % (args.bulbs, len(bridge.groups), len(scan)/1024, len(state)/1024))
+    print('%-26s %10s %10s %10s %10s' % ('', 'old', 'new', 'old peak', 'new peak'))
+    for name, old, new, arg in (('scan (GetEndDevices)', oldScan, newScan, scan), ('status (GetDeviceStatus)', oldStatus, newStatus, state),
+            ('envelope', oldEnvelope, newEnvelope, ids)):
+        oldTime, oldPeak = measure(old, arg, args.repeat)
+        newTime, newPeak = measure(new, arg, args.repeat)
+        print('%-26s %8.1fus %8.1fus %8.1fKB %8.1fKB' % (name, oldTime*1000000, newTime*1000000, oldPeak/1024, newPeak/1024))
@@ -0,0 +1,496 @@
+# WEMO fleet simulator
+#
+# Fake WEMO switches, Insight switches and Link bridges (basicevent1/insight1/bridge1 SOAP endpoints, setup.xml, GENA SUBSCRIBE/UNSUBSCRIBE
+# with NOTIFY on state changes and an SSDP responder) plus a stub Domoticz module, so the plugin can be run and measured without hardware or
+# Domoticz.
+#
+# Run a fleet for manual testing (Ctrl-C to stop):
+#   python3 tools/wemosim.py --switches 10 --bridges 2 --bulbs 8 --latency 0.05
+#
+import sys
+import time
+import collections
+import html
+import http.client
+import queue
+import random
+import re
+import socket
+import socketserver
+import threading
+import types
+import argparse
+import multiprocessing
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import urlsplit
+
+SSDP_ADDR = ('239.255.255.250', 1900)
+
+# Stub Domoticz module: logs are kept (or printed) and devices are stored in the module's Devices dict
+def installDomoticz(verbose=False):
+    stub = types.ModuleType('Domoticz')
+    stub.Devices = {}
+    stub.Parameters = {}
+    stub.messages = []
+
+    def log(level):
+        def write(message):
+            stub.messages.append((level, message))
+            if verbose:
+                print(level+': '+str(message), file=sys.stderr)
+        return write
+
+    class Device:
+        def __init__(self, Name='', Unit=0, Type=0, Subtype=0, Switchtype=0, Image=0, DeviceID='', Options=None, Used=0, TypeName=''):
+            self.Name = Name
+            self.Unit = Unit
+            self.ID = Unit
+            self.Type = Type
+            self.SubType = Subtype
+            self.SwitchType = Switchtype
+            self.Image = Image
+            self.DeviceID = DeviceID
+            self.Options = Options if Options is not None else {}
+            self.nValue = 0
+            self.sValue = ''
+            self.TimedOut = 0
+            self.LastLevel = 0
+            self.updates = 0
+
+        def Create(self):
+            stub.Devices[self.Unit] = self
+
+        def Update(self, nValue=0, sValue='', TimedOut=0, **kwargs):
+            self.nValue = nValue
+            self.sValue = sValue
+            self.TimedOut = TimedOut
+            self.updates += 1
+
+        def Delete(self):
+            stub.Devices.pop(self.Unit, None)
+
+        def __str__(self):
+            return self.Name+' ('+self.DeviceID+') '+str(self.nValue)+':'+str(self.sValue)
+
+    stub.Device = Device
+    stub.Log = log('Log')
+    stub.Status = log('Status')
+    stub.Error = log('Error')
+    stub.Debug = log('Debug')
+    stub.Debugging = lambda level: None
+    sys.modules['Domoticz'] = stub
+    return stub
+
+def envelope(body):
+    return ('<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>'+body+'</s:Body></s:Envelope>').encode('utf-8')
+
+def element(body, tag):
+    m = re.search('<'+tag+'>(.*?)</'+tag+'>', body, re.S)
+    return m.group(1) if m else ''
+
+def propertyset(name, value):
+    return '<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0"><e:property><'+name+'>'+value+'</'+name+'></e:property></e:propertyset>'
+
+# GENA event subscribers of a WEMO (callback by SID), events are sent in order by a thread of their own
+class Publisher:
+    def __init__(self):
+        self.subscribers = {}
+        self.seq = {}
+        self.events = queue.Queue()
+        self.lock = threading.Lock()
+        self.sender = None
+
+    # New subscription (returns its SID) or renewal of sid (returns None if sid is unknown)
+    def subscribe(self, callback, sid=None):
+        with self.lock:
+            if sid is not None:
+                return sid if sid in self.subscribers else None
+            sid = 'uuid:'+self.udn[5:]+'-'+str(random.randint(0, 1000000))
+            self.subscribers[sid] = callback
+            self.seq[sid] = 0
+        return sid
+
+    def unsubscribe(self, sid):
+        with self.lock:
+            self.seq.pop(sid, None)
+            return self.subscribers.pop(sid, None) is not None
+
+    # Queue event body for all subscribers (or only sid)
+    def publish(self, body, sid=None):
+        with self.lock:
+            for s in ([sid] if sid is not None else list(self.subscribers)):
+                if s in self.subscribers:
+                    self.events.put((self.subscribers[s], s, self.seq[s], body))
+                    self.seq[s] += 1
+            if self.sender is None:
+                self.sender = threading.Thread(target=self.sendEvents, daemon=True)
+                self.sender.start()
+
+    def sendEvents(self):
+        while True:
+            callback, sid, seq, body = self.events.get()
+            u = urlsplit(callback)
+            try:
+                conn = http.client.HTTPConnection(u.hostname, u.port, timeout=5)
+                conn.request('NOTIFY', u.path, body.encode('utf-8'), { 'Content-Type' : 'text/xml; charset="utf-8"', 'NT' : 'upnp:event',
+                    'NTS' : 'upnp:propchange', 'SID' : sid, 'SEQ' : str(seq) })
+                conn.getresponse().read()
+                conn.close()
+            except (OSError, http.client.HTTPException):
+                pass
+
+    def initialEvent(self):
+        return None
+
+# WEMO on/off switch
+class Switch(Publisher):
+    def __init__(self, n):
+        Publisher.__init__(self)
+        self.udn = 'uuid:Socket-1_0-SIM%05d' % n
+        self.name = 'Switch %d' % n
+        self.state = '0'
+
+    # Change state (as the WEMO app or its button would), notifying subscribers
+    def setState(self, state):
+        if state != self.state:
+            self.state = state
+            self.publish(propertyset('BinaryState', state))
+
+    def initialEvent(self):
+        return propertyset('BinaryState', self.state)
+
+    def soap(self, action, body):
+        if action == 'GetFriendlyName':
+            return '<u:GetFriendlyNameResponse xmlns:u="urn:Belkin:service:basicevent:1"><FriendlyName>'+self.name+'</FriendlyName></u:GetFriendlyNameResponse>'
+        if action == 'SetBinaryState':
+            self.setState(element(body, 'BinaryState'))
+        if action in ('GetBinaryState', 'SetBinaryState'):
+            return '<u:'+action+'Response xmlns:u="urn:Belkin:service:basicevent:1"><BinaryState>'+self.state+'</BinaryState></u:'+action+'Response>'
+        return None
+
+# WEMO Insight switch (reports state 8 when on without load)
+class Insight(Switch):
+    def __init__(self, n):
+        Switch.__init__(self, n)
+        self.udn = 'uuid:Insight-1_0-INS%05d' % n
+        self.name = 'Insight %d' % n
+        self.power = 60000
+        self.total = 0.0
+        self.start = time.time()
+
+    def soap(self, action, body):
+        if action == 'GetInsightParams':
+            # Energy used since the simulator started (mW*min)
+            minutes = (time.time()-self.start)/60
+            power = self.power if self.state != '0' else 0
+            state = '8' if self.state != '0' and power == 0 else self.state
+            params = [state, str(int(self.start)), '0', '0', '0', '1209600', '19', str(power), str(int(power*minutes)), '%.6f' % (power*minutes), '8000']
+            return '<u:GetInsightParamsResponse xmlns:u="urn:Belkin:service:insight:1"><InsightParams>'+'|'.join(params)+'</InsightParams></u:GetInsightParamsResponse>'
+        return Switch.soap(self, action, body)
+
+# WEMO Link bridge with bulbs (the first ones split in groups)
+class Bridge(Publisher):
+    def __init__(self, n, bulbs=8, groups=1, perGroup=2):
+        Publisher.__init__(self)
+        self.udn = 'uuid:Bridge-1_0-SIM%05d' % n
+        self.bulbs = collections.OrderedDict([('B%05d%03d' % (n, i), ['1', '255:0']) for i in range(0, bulbs)])
+        ids = list(self.bulbs)
+        self.groups = {}
+        for g in range(0, groups):
+            members = ids[g*perGroup:(g+1)*perGroup]
+            if len(members) > 0:
+                self.groups['G%05d%03d' % (n, g)] = members
+        for gid in self.groups:
+            self.bulbs[gid] = ['1', '255:0']
+
+    def soap(self, action, body):
+        body = html.unescape(body)
+        if action == 'GetEndDevices':
+            grouped = set([m for members in self.groups.values() for m in members])
+            inner = '<DeviceLists><DeviceList><DeviceListType>Paired</DeviceListType><DeviceInfos>'
+            for devid in self.bulbs:
+                if devid not in self.groups and devid not in grouped:
+                    inner += self.deviceInfo(devid)
+            inner += '</DeviceInfos><GroupInfos>'
+            for gid in self.groups:
+                inner += '<GroupInfo><GroupID>'+gid+'</GroupID><GroupName>Group '+gid+'</GroupName><GroupCapabilityIDs>10006,10008</GroupCapabilityIDs><DeviceInfos>'
+                for devid in self.groups[gid]:
+                    inner += self.deviceInfo(devid)
+                inner += '</DeviceInfos></GroupInfo>'
+            inner += '</GroupInfos></DeviceList></DeviceLists>'
+            return '<u:GetEndDevicesResponse xmlns:u="urn:Belkin:service:bridge:1"><DeviceLists>'+html.escape(inner)+'</DeviceLists></u:GetEndDevicesResponse>'
+        if action == 'GetDeviceStatus':
+            ids = element(body, 'DeviceIDs')
+            ids = ids.split(',') if ids != '' else list(self.bulbs)
+            inner = '<DeviceStatusList>'
+            for devid in ids:
+                value = self.bulbs.get(devid)
+                inner += '<DeviceStatus><IsGroupAction>'+('YES' if devid in self.groups else 'NO')+'</IsGroupAction>' \
+                    '<DeviceID available="'+('YES' if value else 'NO')+'">'+devid+'</DeviceID><CapabilityID>10006,10008</CapabilityID>' \
+                    '<CapabilityValue>'+(value[0]+','+value[1] if value else ',')+'</CapabilityValue></DeviceStatus>'
+            inner += '</DeviceStatusList>'
+            return '<u:GetDeviceStatusResponse xmlns:u="urn:Belkin:service:bridge:1"><DeviceStatusList>'+html.escape(inner)+'</DeviceStatusList></u:GetDeviceStatusResponse>'
+        if action == 'SetDeviceStatus':
+            errors = []
+            for status in re.findall('<DeviceStatus>(.*?)</DeviceStatus>', body, re.S):
+                devid = element(status, 'DeviceID')
+                capabilities = element(status, 'CapabilityID').split(',')
+                values = element(status, 'CapabilityValue').split(',')
+                if devid not in self.bulbs:
+                    errors.append(devid)
+                    continue
+                for i in range(0, min(len(capabilities), len(values))):
+                    self.setStatus(devid, capabilities[i], values[i])
+            return '<u:SetDeviceStatusResponse xmlns:u="urn:Belkin:service:bridge:1"><ErrorDeviceIDs>'+','.join(errors)+'</ErrorDeviceIDs></u:SetDeviceStatusResponse>'
+        return None
+
+    # Change capability (10006 on/off, 10008 level) of bulb or group (and its members), notifying subscribers of each change
+    def setStatus(self, devid, capability, value):
+        if capability not in ('10006', '10008'):
+            return
+        index = 0 if capability == '10006' else 1
+        for d in [devid]+self.groups.get(devid, []):
+            if self.bulbs[d][index] != value:
+                self.bulbs[d][index] = value
+                event = '<?xml version="1.0" encoding="utf-8"?><StateEvent><DeviceID available="YES">'+d+'</DeviceID><CapabilityId>'+capability+'</CapabilityId><Value>'+value+'</Value></StateEvent>'
+                self.publish(propertyset('StatusChange', html.escape(event)))
+
+    def deviceInfo(self, devid):
+        return '<DeviceInfo><DeviceIndex>0</DeviceIndex><DeviceID>'+devid+'</DeviceID><FriendlyName>Bulb '+devid+'</FriendlyName><IconVersion>1</IconVersion><FirmwareVersion>01</FirmwareVersion><CapabilityIDs>10006,10008,30008,30009,3000A</CapabilityIDs><CurrentState>'+','.join(self.bulbs[devid])+'</CurrentState></DeviceInfo>'
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    # Clients closing connections (plugin stopping, lost requests) are expected
+    def handle_error(self, request, client_address):
+        if not issubclass(sys.exc_info()[0], ConnectionError):
+            HTTPServer.handle_error(self, request, client_address)
+
+# HTTP server of one simulated WEMO, with injectable latency and loss (connection closed without a response)
+def serveWEMO(wemo, fleet):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def reply(self, status, body=b'', headers={}):
+            self.send_response(status)
+            for name in headers:
+                self.send_header(name, headers[name])
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def simulate(self):
+            fleet.count()
+            if fleet.latency > 0:
+                time.sleep(fleet.latency)
+            if fleet.loss > 0 and random.random() < fleet.loss:
+                self.close_connection = True
+                return False
+            return True
+
+        def do_GET(self):
+            if not self.simulate():
+                return
+            if self.path != '/setup.xml':
+                return self.reply(404)
+            self.reply(200, ('<?xml version="1.0"?><root xmlns="urn:Belkin:device-1-0"><device><friendlyName>'+wemo.udn+'</friendlyName><UDN>'+wemo.udn+'</UDN></device></root>').encode('utf-8'), { 'Content-Type' : 'text/xml' })
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8')
+            if not self.simulate():
+                return
+            action = self.headers.get('SOAPACTION', '').strip('"').split('#')[-1]
+            response = wemo.soap(action, body)
+            if response is None:
+                return self.reply(500, envelope('<s:Fault><faultcode>s:Client</faultcode><faultstring>UPnPError</faultstring></s:Fault>'))
+            self.reply(200, envelope(response), { 'Content-Type' : 'text/xml; charset="utf-8"' })
+
+        def do_SUBSCRIBE(self):
+            if not self.simulate():
+                return
+            callback = self.headers.get('CALLBACK', '').strip('<>')
+            if 'SID' in self.headers:
+                sid = wemo.subscribe(None, self.headers['SID'])
+            elif callback.startswith('http://') and self.headers.get('NT') == 'upnp:event':
+                sid = wemo.subscribe(callback)
+            else:
+                return self.reply(400)
+            if sid is None:
+                return self.reply(412)
+            self.reply(200, b'', { 'SID' : sid, 'TIMEOUT' : self.headers.get('TIMEOUT', 'Second-600') })
+            # New subscription gets an initial event with current state (after the response carrying its SID)
+            body = wemo.initialEvent()
+            if 'SID' not in self.headers and body is not None:
+                wemo.publish(body, sid)
+
+        def do_UNSUBSCRIBE(self):
+            if not self.simulate():
+                return
+            self.reply(200 if wemo.unsubscribe(self.headers.get('SID', '')) else 412)
+
+    server = ThreadingHTTPServer((fleet.host, 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    wemo.server = server
+    wemo.location = 'http://'+fleet.host+':'+str(server.server_address[1])
+    return wemo
+
+# Fleet of simulated WEMOs: switches, bridges and dead WEMOs (announced but refusing connections)
+class Fleet:
+    def __init__(self, switches=0, bridges=0, bulbs=8, groups=1, perGroup=2, dead=0, latency=0.0, loss=0.0, host='127.0.0.1', insights=0):
+        self.host = host
+        self.latency = latency
+        self.loss = loss
+        self.requests = 0
+        self.lock = threading.Lock()
+        self.wemos = [Switch(n) for n in range(0, switches)] + [Insight(n) for n in range(0, insights)] + [Bridge(n, bulbs, groups, perGroup) for n in range(0, bridges)]
+        self.dead = [Switch(switches+n) for n in range(0, dead)]
+        self.ssdp = None
+
+    def count(self):
+        with self.lock:
+            self.requests += 1
+
+    def start(self, ssdp=False):
+        for wemo in self.wemos:
+            serveWEMO(wemo, self)
+        # Dead WEMOs get a port nobody listens on
+        for wemo in self.dead:
+            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            s.bind((self.host, 0))
+            wemo.location = 'http://'+self.host+':'+str(s.getsockname()[1])
+            s.close()
+        if ssdp:
+            self.ssdp = threading.Thread(target=self.respondSSDP, daemon=True)
+            self.ssdp.start()
+        return self
+
+    def stop(self):
+        for wemo in self.wemos:
+            wemo.server.shutdown()
+            wemo.server.server_close()
+
+    # Switch every switch and bulb on ('1') or off ('0') as if done outside Domoticz
+    def setAll(self, state):
+        for wemo in self.wemos:
+            if isinstance(wemo, Bridge):
+                for devid in wemo.bulbs:
+                    wemo.setStatus(devid, '10006', state)
+            else:
+                wemo.setState(state)
+
+    # Event subscriptions of all WEMOs
+    def subscriptions(self):
+        return sum([len(wemo.subscribers) for wemo in self.wemos])
+
+    # (udn, location) of every WEMO (to seed the plugin without SSDP)
+    def locations(self):
+        return [(w.udn, w.location) for w in self.wemos+self.dead]
+
+    # Number of Domoticz devices the plugin should create for this fleet
+    def devices(self):
+        count = 0
+        for wemo in self.wemos+self.dead:
+            if isinstance(wemo, Bridge):
+                grouped = sum([len(m) for m in wemo.groups.values()])
+                count += len(wemo.bulbs)-grouped
+            elif isinstance(wemo, Insight):
+                count += 3
+            else:
+                count += 1
+        return count
+
+    def announcement(self, wemo, start):
+        return start+'CACHE-CONTROL: max-age=86400\r\nLOCATION: '+wemo.location+'/setup.xml\r\nST: upnp:rootdevice\r\n' \
+            'USN: '+wemo.udn+'::upnp:rootdevice\r\nBOOTID.UPNP.ORG: 1\r\nSERVER: Unspecified, UPnP/1.0, Unspecified\r\n\r\n'
+
+    # Answer M-SEARCH requests (each answer may be lost) and announce the fleet once
+    def respondSSDP(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        s.bind(('', SSDP_ADDR[1]))
+        s.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(SSDP_ADDR[0])+socket.inet_aton('0.0.0.0'))
+        out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        for wemo in self.wemos+self.dead:
+            out.sendto(self.announcement(wemo, 'NOTIFY * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nNT: upnp:rootdevice\r\nNTS: ssdp:alive\r\n').encode(), SSDP_ADDR)
+        while True:
+            data, addr = s.recvfrom(65507)
+            data = data.decode('utf-8', 'replace')
+            if not data.startswith('M-SEARCH') or ('upnp:rootdevice' not in data and 'ssdp:all' not in data):
+                continue
+            for wemo in self.wemos+self.dead:
+                if self.loss > 0 and random.random() < self.loss:
+                    continue
+                out.sendto(self.announcement(wemo, 'HTTP/1.1 200 OK\r\nEXT:\r\n').encode(), addr)
+
+# Fleet running in its own process (so it doesn't skew CPU/memory measurements of the plugin)
+class FleetProcess:
+    def __init__(self, ssdp=False, **options):
+        self.ssdp = ssdp
+        self.options = options
+
+    def start(self):
+        self.conn, child = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=runFleet, args=(child, self.ssdp, self.options), daemon=True)
+        self.process.start()
+        self.wemos, self.devices = self.conn.recv()
+        return self
+
+    # Requests served so far
+    def requests(self):
+        self.conn.send('requests')
+        return self.conn.recv()
+
+    def setAll(self, state):
+        self.conn.send('off' if state == '0' else 'on')
+        self.conn.recv()
+
+    def subscriptions(self):
+        self.conn.send('subscriptions')
+        return self.conn.recv()
+
+    def stop(self):
+        self.conn.send('stop')
+        self.process.join(5)
+
+def runFleet(conn, ssdp, options):
+    fleet = Fleet(**options).start(ssdp)
+    conn.send((fleet.locations(), fleet.devices()))
+    while True:
+        command = conn.recv()
+        if command == 'requests':
+            conn.send(fleet.requests)
+        elif command in ('on', 'off'):
+            fleet.setAll('1' if command == 'on' else '0')
+            conn.send(True)
+        elif command == 'subscriptions':
+            conn.send(fleet.subscriptions())
+        elif command == 'stop':
+            fleet.stop()
+            return
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Simulate a fleet of WEMO devices')
+    parser.add_argument('--switches', type=int, default=5)
+    parser.add_argument('--insights', type=int, default=0)
+    parser.add_argument('--bridges', type=int, default=1)
+    parser.add_argument('--bulbs', type=int, default=8, help='bulbs per bridge')
+    parser.add_argument('--groups', type=int, default=1, help='groups per bridge')
+    parser.add_argument('--per-group', type=int, default=2, help='bulbs per group')
+    parser.add_argument('--dead', type=int, default=0, help='WEMOs announced but refusing connections')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds added to each request')
+    parser.add_argument('--loss', type=float, default=0.0, help='fraction of requests/SSDP answers dropped')
+    parser.add_argument('--host', default='127.0.0.1', help='address to serve WEMOs on')
+    args = parser.parse_args()
+    fleet = Fleet(args.switches, args.bridges, args.bulbs, args.groups, args.per_group, args.dead, args.latency, args.loss, args.host, args.insights).start(ssdp=True)
+    for udn, location in fleet.locations():
+        print(udn+' '+location)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        fleet.stop()